@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# geometry.py
+# Micro-benchmark of the PylosState neighbourhood checks.
+# Compares the nested-list state of pylos_non_mod.py (coordinates recomputed and
+# bounds checked with exceptions on every call) with the packed state of pylos.py
+# (precomputed SUPPORTS/RESTING/CELLSQUARES tables).
+#
+# Usage: python -m bench.geometry [--number N]
+
+import argparse
+import json
+import timeit
+
+import pylos
+import pylos_non_mod
+from lib import game
+
+# A mid-game position: the first layer is almost full and the second one started
+MOVES = [
+    [0, 0, 0], [0, 0, 1], [0, 1, 0], [0, 1, 1], [1, 0, 0], [0, 0, 2], [0, 1, 2],
+    [0, 0, 3], [0, 1, 3], [0, 2, 0], [0, 3, 0], [0, 2, 1], [0, 3, 1], [1, 1, 0],
+    [0, 2, 2], [0, 2, 3]
+]
+
+
+def _position():
+    state = pylos.PylosState()
+    for coord in MOVES:
+        state.update({'move': 'place', 'to': coord}, state.turn)
+    return state
+
+
+def _probe(check, cells):
+    def run():
+        for cell in cells:
+            try:
+                check(*cell)
+            except game.InvalidMoveException:
+                pass
+    return run
+
+
+def _square(state, cells):
+    def run():
+        for cell in cells:
+            state.createSquare(cell)
+    return run
+
+
+def _scan(state):
+    # What Tree._possibleplacement used to do: probe every cell with validPosition
+    def run():
+        placements = []
+        for cell in pylos.CELLS:
+            try:
+                state.validPosition(*cell)
+                placements.append(cell)
+            except game.InvalidMoveException:
+                pass
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PylosState geometry micro-benchmark')
+    parser.add_argument('--number', type=int, default=2000, help='iterations per check (default: 2000)')
+    args = parser.parse_args()
+
+    packed = _position()
+    nested = pylos_non_mod.PylosState(json.loads(str(packed)))
+    cells = pylos.CELLS
+
+    print('{:<16}{:>14}{:>14}{:>10}'.format('check', 'lists (ns)', 'tables (ns)', 'speedup'))
+    for name, old, new in (
+        ('validPosition', _probe(nested.validPosition, cells), _probe(packed.validPosition, cells)),
+        ('canMove', _probe(nested.canMove, cells), _probe(packed.canMove, cells)),
+        ('createSquare', _square(nested, cells), _square(packed, cells)),
+        ('placements', _scan(nested), packed.placements),
+    ):
+        calls = args.number * (1 if name == 'placements' else len(cells))
+        before = min(timeit.repeat(old, number=args.number, repeat=3)) / calls * 1e9
+        after = min(timeit.repeat(new, number=args.number, repeat=3)) / calls * 1e9
+        print('{:<16}{:>14.0f}{:>14.0f}{:>9.1f}x'.format(name, before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
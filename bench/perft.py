@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# perft.py
+# Move generation benchmark: counts the leaf nodes of the game tree at depths
+# 1..N from reference positions, compares them with the expected counts and
+# reports nodes per second.
+#
+# A position where the game is over is a leaf with no children: it counts
+# for 0 at any depth below it.
+#
+# Usage: python -m bench.perft [--depth N] [--position NAME] [--update]
+#   --update plays every move with PylosState.update (the server path) on a
+#   copy of the state instead of apply/undo.
+
+import argparse
+import copy
+import json
+import sys
+import time
+
+import pylos
+
+# name: (visible state as sent by the server, None for the opening; leaf counts at depth 1, 2, ...)
+POSITIONS = {
+    'opening': (None, [16, 240, 3360, 43680, 524376]),
+    'square': (
+        '{"board":[[[0,null,1,1],[1,null,null,0],[null,1,0,0],[null,1,0,null]],[[null,null,null],'
+        '[null,null,null],[null,null,null]],[[null,null],[null,null]],[[null]]],"reserve":[10,10],"turn":0}',
+        [52, 535, 11430, 263068]
+    ),
+    'layer1': (
+        '{"board":[[[null,1,1,1],[1,null,0,0],[1,0,0,0],[null,1,0,1]],[[null,null,1],[null,null,1],'
+        '[null,0,null]],[[null,null],[null,null]],[[null]]],"reserve":[8,6],"turn":0}',
+        [9, 115, 932, 26914]
+    ),
+    'endgame': (
+        '{"board":[[[0,null,0,0],[0,0,1,0],[0,1,0,0],[1,1,1,null]],[[null,null,0],[1,0,null],'
+        '[0,1,null]],[[null,null],[1,null]],[[null]]],"reserve":[3,7],"turn":0}',
+        [17, 66, 727, 2948]
+    ),
+}
+
+
+def perft(state, depth):
+    '''Count the leaves 'depth' plies below 'state' with apply/undo.'''
+    if depth == 0:
+        return 1
+    if state.winner() != -1:
+        return 0
+    if depth == 1:
+        return sum(1 for move in state.moves())
+    nodes = 0
+    for move in state.moves():
+        record = state.apply(move)
+        nodes += perft(state, depth - 1)
+        state.undo(record)
+    return nodes
+
+
+def perftupdate(state, depth):
+    '''Count the leaves 'depth' plies below 'state' with PylosState.update.'''
+    if depth == 0:
+        return 1
+    if state.winner() != -1:
+        return 0
+    nodes = 0
+    for move in list(state.moves()):
+        child = copy.deepcopy(state)
+        child.update(pylos.decodemove(move), child.turn)
+        nodes += perftupdate(child, depth - 1)
+    return nodes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pylos move generation benchmark')
+    parser.add_argument('--depth', type=int, help='maximal depth (default: every stored depth)')
+    parser.add_argument('--position', choices=sorted(POSITIONS), action='append',
+                        help='reference position to run (default: all)')
+    parser.add_argument('--update', action='store_true', help='play the moves with update instead of apply/undo')
+    args = parser.parse_args()
+
+    count = perftupdate if args.update else perft
+    failures = 0
+    print('{:<10}{:>6}{:>12}{:>12}{:>10}{:>12}'.format('position', 'depth', 'nodes', 'expected', 'time (s)', 'nodes/s'))
+    for name in args.position or POSITIONS:
+        visible, expected = POSITIONS[name]
+        state = pylos.PylosState(None if visible is None else json.loads(visible))
+        for depth in range(1, len(expected) + 1 if args.depth is None else args.depth + 1):
+            start = time.perf_counter()
+            nodes = count(state, depth)
+            elapsed = time.perf_counter() - start
+            reference = expected[depth - 1] if depth <= len(expected) else None
+            if reference is not None and nodes != reference:
+                failures += 1
+            print('{:<10}{:>6}{:>12}{:>12}{:>10.3f}{:>12.0f}{}'.format(
+                name, depth, nodes, '?' if reference is None else reference, elapsed,
+                nodes / elapsed if elapsed > 0 else 0, '  MISMATCH' if reference not in (None, nodes) else ''
+            ))
+    if failures:
+        print('{} count(s) differ from the expected values.'.format(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,23 @@
 # Version: April 20, 2016
 
 from abc import *
+import asyncio
 import copy
 import json
+import math
 import socket
+import struct
 import sys
+import time
+import zlib
 
 DEFAULT_BUFFER_SIZE = 1024
 SECTION_WIDTH = 60
+# Every message is sent as its length (4 bytes, big-endian) followed by its bytes
+MESSAGE_HEADER = struct.Struct('!I')
+MAX_MESSAGE_SIZE = 1 << 24
+# With delta updates, one DELTA message out of CHECKSUM_INTERVAL carries a checksum of the state
+CHECKSUM_INTERVAL = 8
 
 
 def _printsection(title):
@@ -23,8 +33,83 @@ class InvalidMoveException(Exception):
         super().__init__(message)
 
 
+class MessageSocket:
+    '''Length-prefixed messages over a connected stream socket.
+
+    Received bytes are buffered, so a message split over several TCP segments
+    or several messages arriving in a single one are all read back exactly as
+    they were sent.
+    '''
+    def __init__(self, sock, buffersize=DEFAULT_BUFFER_SIZE):
+        self.__socket = sock
+        self.__buffersize = buffersize
+        self.__buffer = bytearray()
+
+    def send(self, data):
+        '''Send the bytes 'data' as one message.'''
+        self.__socket.sendall(MESSAGE_HEADER.pack(len(data)) + data)
+
+    def recv(self):
+        '''Wait for the next whole message and return its bytes.
+
+        Raises ConnectionError: If the connection is closed before the message
+                                is complete, or if its announced size is too big.
+        '''
+        buffer = self.__buffer
+        header = MESSAGE_HEADER.size
+        while True:
+            if len(buffer) >= header:
+                size = MESSAGE_HEADER.unpack_from(buffer)[0]
+                if size > MAX_MESSAGE_SIZE:
+                    raise ConnectionError('message of {} bytes is too big'.format(size))
+                if len(buffer) >= header + size:
+                    message = bytes(buffer[header:header + size])
+                    del buffer[:header + size]
+                    return message
+                missing = header + size - len(buffer)
+            else:
+                missing = header - len(buffer)
+            data = self.__socket.recv(max(self.__buffersize, missing))
+            if not data:
+                raise ConnectionError('connection closed by peer')
+            buffer += data
+
+    def getpeername(self):
+        return self.__socket.getpeername()
+
+    def close(self):
+        self.__socket.close()
+
+
+def writemessage(writer, data):
+    '''Write the bytes 'data' as one message on an asyncio StreamWriter.'''
+    writer.write(MESSAGE_HEADER.pack(len(data)) + data)
+
+
+async def readmessage(reader):
+    '''Read the next whole message from an asyncio StreamReader.
+
+    Raises ConnectionError: If the stream ends before the message is complete,
+                            or if its announced size is too big.
+    '''
+    try:
+        size = MESSAGE_HEADER.unpack(await reader.readexactly(MESSAGE_HEADER.size))[0]
+        if size > MAX_MESSAGE_SIZE:
+            raise ConnectionError('message of {} bytes is too big'.format(size))
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError('connection closed by peer')
+
+
 class GameState(metaclass=ABCMeta):
     '''Abstract class representing a generic game state.'''
+    # Whether serialize and parse implement a compact binary encoding, which
+    # the server then offers to the clients when the game starts
+    BINARY = False
+    # Whether applymove is implemented, so that the clients can follow the game
+    # from the moves only (delta updates, offered like the binary encoding)
+    DELTA = False
+
     def __init__(self, visible, hidden=None):
         self._state = {'visible': visible, 'hidden': hidden}
 
@@ -54,22 +139,136 @@ class GameState(metaclass=ABCMeta):
         Post: This state has been printed on stdout.'''
         ...
 
+    def serialize(self, binary=False):
+        '''Encode the state as sent to the clients.
+
+        Pre: 'binary' is False unless the class supports it (see BINARY).
+        Post: The returned value is the bytes of the JSON visible state, or
+              of the compact binary encoding if 'binary'.
+        '''
+        return str(self).encode()
+
     @classmethod
-    def parse(cls, state):
+    def parse(cls, state, binary=False):
+        '''Decode a state encoded by serialize (str or bytes for JSON).'''
         return cls(json.loads(state))
 
+    def snapshot(self):
+        '''Return a view of this state that later changes do not affect.
+
+        The default snapshot is a deep copy; subclasses can return a cheaper
+        immutable form. Copying a snapshot gives back a regular state.
+        '''
+        return copy.deepcopy(self)
+
+    def checksum(self, binary=False):
+        '''CRC-32 of the serialized state, used to check delta updates.'''
+        return zlib.crc32(self.serialize(binary))
+
+    # Size in bytes of the moves encoded by packmove (None if not implemented)
+    MOVESIZE = None
+
+    @classmethod
+    def packmove(cls, move, player):
+        '''Encode a valid move, as sent by a client, played by 'player' in
+        MOVESIZE bytes (used by the game logs, see lib/gamelog.py).'''
+        raise NotImplementedError('{} cannot pack moves'.format(cls.__name__))
+
+    @classmethod
+    def unpackmove(cls, data):
+        '''Decode a move encoded by packmove into a (move, player) pair, where
+        str(move) is the move as it was sent by the client.'''
+        raise NotImplementedError('{} cannot pack moves'.format(cls.__name__))
+
+    def applymove(self, move, player):
+        '''Apply a move, as sent by a client, to this state.
+
+        Pre: The class supports delta updates (see DELTA).
+        Post: The specified 'move' has been played by 'player'.
+        Raises InvalidMoveException: If 'move' is invalid.
+        '''
+        raise NotImplementedError('{} does not support delta updates'.format(self.__class__.__name__))
+
     @classmethod
     def buffersize(cls):
         return DEFAULT_BUFFER_SIZE
 
 
+class TurnStats:
+    '''Durations of the phases of the turns of a game, per player.
+
+    The phases of a turn are: sending the PLAY (or DELTA) message, waiting for
+    the move (think time of the player and network), parsing and applying the
+    move, checking for a winner and, in verbose mode, printing the state. Each
+    duration falls in a histogram bucket, the one of the smallest power of two
+    microseconds it does not exceed; the samples are kept for exact percentiles.
+    '''
+    PHASES = ('send', 'wait', 'apply', 'winner', 'print')
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, nbplayers):
+        self.__samples = [{phase: [] for phase in self.PHASES} for i in range(nbplayers)]
+
+    def record(self, player, phase, seconds):
+        self.__samples[player][phase].append(seconds)
+
+    @staticmethod
+    def _percentile(ordered, percent):
+        # Nearest-rank percentile of a sorted non-empty list
+        return ordered[max(0, -(-len(ordered) * percent // 100) - 1)]
+
+    def summary(self):
+        '''Return, for each player and phase with samples, the count, total,
+        mean, maximum and percentiles (in seconds) and the histogram (upper
+        bound of the bucket in microseconds: count).'''
+        players = []
+        for phases in self.__samples:
+            summary = {}
+            for phase, samples in phases.items():
+                if not samples:
+                    continue
+                ordered = sorted(samples)
+                histogram = {}
+                for seconds in ordered:
+                    bound = 1 << max(0, math.ceil(seconds * 1e6) - 1).bit_length()
+                    histogram[bound] = histogram.get(bound, 0) + 1
+                summary[phase] = dict(
+                    count=len(ordered), total=sum(ordered), mean=sum(ordered) / len(ordered), max=ordered[-1],
+                    histogram=histogram,
+                    **{'p{}'.format(percent): self._percentile(ordered, percent) for percent in self.PERCENTILES}
+                )
+            players.append(summary)
+        return players
+
+
+def _result(winner):
+    return 'aborted' if winner == -1 else 'draw' if winner is None else 'won by player {}'.format(winner)
+
+
 class GameServer(metaclass=ABCMeta):
-    '''Abstract class representing a generic game server.'''
-    def __init__(self, name, nbplayers, initialstate, verbose=False):
+    '''Abstract class representing a generic game server.
+
+    With 'series' > 1, the players who accept it play that many games over
+    the same connections, the colours rotating from one game to the next.
+    Every finished game is written to 'log', a gamelog.GameLog, if given.
+    With a text stream 'stats', the time taken by each phase of every turn is
+    measured (see TurnStats) and a JSON summary is written to it, one line per
+    game, when the game ends.
+    '''
+    def __init__(self, name, nbplayers, initialstate, verbose=False, series=1, log=None, stats=None):
+        if log is not None and initialstate.MOVESIZE is None:
+            raise ValueError('{} cannot pack moves, its games cannot be logged'.format(initialstate.__class__.__name__))
         self.__name = name
         self.__nbplayers = nbplayers
         self.__verbose = verbose
+        self.__series = series
+        self.__log = log
+        self.__stats = stats
+        self.__turnstats = None
         self._state = initialstate
+        self.__initialstate = initialstate.snapshot()
+        # Snapshot of the state, taken at the first read after each move
+        self.__snapshot = None
         # Stats about the running game
         self.__currentplayer = None
         self.__turns = 0
@@ -90,6 +289,10 @@ class GameServer(metaclass=ABCMeta):
     def turns(self):
         return self.__turns
 
+    @property
+    def series(self):
+        return self.__series
+
     @abstractmethod
     def applymove(self, move):
         '''Apply a move.
@@ -102,7 +305,10 @@ class GameServer(metaclass=ABCMeta):
 
     @property
     def state(self):
-        return copy.deepcopy(self._state)
+        '''Immutable snapshot of the current state (see GameState.snapshot).'''
+        if self.__snapshot is None:
+            self.__snapshot = self._state.snapshot()
+        return self.__snapshot
 
     def _waitplayers(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -120,7 +326,7 @@ class GameServer(metaclass=ABCMeta):
         # Wait for enough players for a play
         try:
             while len(self.__players) < self.__nbplayers:
-                client = s.accept()[0]
+                client = MessageSocket(s.accept()[0], self._state.__class__.buffersize())
                 self.__players.append(client)
                 if self.__verbose:
                     print(' - Client connected from {}:{} ({}/{}).'
@@ -131,30 +337,116 @@ class GameServer(metaclass=ABCMeta):
                 player.close()
             _printsection('Game server ended')
             return False
+        return self._handshake()
+
+    def _handshake(self):
         # Notify players that the game started
+        options = []
         try:
             for i in range(len(self.__players)):
                 if self.__verbose:
                     print(' Initialising player {}...'.format(i))
                 player = self.__players[i]
-                player.sendall('START {}'.format(i).encode())
-                data = player.recv(self._state.__class__.buffersize()).decode().split(' ')
+                player.send(self._startmessage(i).encode())
+                data = player.recv().decode().split(' ')
                 if data[0] != 'READY':
                     if self.__verbose:
                         print(' - Player {} not ready to start.'.format(i))
                         _printsection('Current game ended')
                     return False
-                elif self.__verbose:
-                    print(' - Player {} ({}) ready to start.'.format(i, data[1] if len(data) == 2 else 'Anonymous'))
+                options.append(self._readyoptions(data))
+                if self.__verbose:
+                    name, binary, delta = options[i][:3]
+                    print(' - Player {} ({}) ready to start{}{}.'.format(
+                        i, name or 'Anonymous', ' (binary states)' if binary else '', ' (delta updates)' if delta else ''
+                    ))
         except OSError:
             if self.__verbose:
                 print('Error while notifying player {}.'.format(player))
             return False
         # Start the game since all the players are ready
+        self._startgame(options)
         if self.__verbose:
             _printsection('Game initialised (all players ready to start)')
         return True
 
+    def _startmessage(self, player):
+        '''START message of 'player', followed by the options offered to him.'''
+        return 'START {}'.format(player) + (' +binary' if self._state.BINARY else '') + \
+            (' +delta' if self._state.DELTA else '') + (' +series' if self.__series > 1 else '')
+
+    def _readyoptions(self, data):
+        '''Return the (name, binary, delta, series) announced in the split READY message 'data'.'''
+        names = [word for word in data[1:] if not word.startswith('+')]
+        return (names[0] if names else None, '+binary' in data and self._state.BINARY,
+                '+delta' in data and self._state.DELTA, '+series' in data and self.__series > 1)
+
+    def _startgame(self, options):
+        '''Reset the protocol state of the game, 'options' being the
+        (name, binary, delta, series) of each player.'''
+        self.__names = [option[0] for option in options]
+        self.__binary = [option[1] for option in options]
+        self.__delta = [option[2] for option in options]
+        # The series goes on only if every player accepted it
+        self.__inseries = all(option[3] for option in options)
+        # Moves applied so far, and index of the first one each player has not received
+        self.__moves = []
+        self.__sent = [None] * len(options)
+        self.__deltas = [0] * len(options)
+        if self.__stats is not None:
+            self.__turnstats = TurnStats(len(options))
+
+    def _playmessage(self, player):
+        '''PLAY message with the full state, or DELTA message with the moves
+        applied since the last message sent to a player using delta updates.'''
+        binary = self.__binary[player]
+        if not self.__delta[player] or self.__sent[player] is None:
+            self.__sent[player] = len(self.__moves)
+            return b'PLAY ' + self.state.serialize(binary)
+        moves = self.__moves[self.__sent[player]:]
+        self.__sent[player] = len(self.__moves)
+        self.__deltas[player] += 1
+        checksum = self.state.checksum(binary) if self.__deltas[player] % CHECKSUM_INTERVAL == 0 else None
+        return 'DELTA {}'.format(json.dumps({'moves': moves, 'checksum': checksum}, separators=(',', ':'))).encode()
+
+    def _resync(self, player):
+        '''Make the next message to 'player' a PLAY message with the full state.'''
+        self.__sent[player] = None
+
+    def _playmove(self, move):
+        '''Apply the move of the current player and give the turn to the next one.'''
+        # Even an invalid move may have changed the state before being refused
+        self.__snapshot = None
+        self.applymove(move)
+        self.__moves.append((self.__currentplayer, move))
+        self.__turns += 1
+        self.__currentplayer = (self.__currentplayer + 1) % self.nbplayers
+
+    def _timeturn(self, player, *times):
+        '''Record the phases of a turn of 'player', 'times' being the
+        perf_counter values at the start of the turn and at the end of each
+        phase of TurnStats.PHASES, in order (the last ones may be left out).'''
+        if self.__turnstats is not None:
+            for phase, start, end in zip(TurnStats.PHASES, times, times[1:]):
+                self.__turnstats.record(player, phase, end - start)
+
+    def _logresult(self, winner):
+        '''Hand the game that just ended to the log, if any, and write its
+        turn statistics to the stats stream, if any.'''
+        if self.__log is not None:
+            self.__log.write(self._state.__class__, self.__names, winner, self.__moves)
+        if self.__turnstats is not None:
+            stats = {'game': self.name, 'players': self.__names, 'result': _result(winner), 'turns': self.__turns,
+                     'phases': self.__turnstats.summary()}
+            self.__stats.write(json.dumps(stats, separators=(',', ':')) + '\n')
+            self.__stats.flush()
+
+    def _nextgame(self):
+        '''Reset the state for the next game of a series.'''
+        self._state = copy.deepcopy(self.__initialstate)
+        self.__snapshot = None
+        self.__turns = 0
+
     def _gameloop(self):
         self.__currentplayer = 0
         winner = -1
@@ -163,53 +455,272 @@ class GameServer(metaclass=ABCMeta):
             self._state.prettyprint()
         # Loop until the game ends with a winner or with a draw
         while winner == -1:
-            player = self.__players[self.__currentplayer]
+            current = self.__currentplayer
+            player = self.__players[current]
             if self.__verbose:
-                print("\n=> Turn #{} (player {})".format(self.turns, self.__currentplayer))
-            player.sendall('PLAY {}'.format(self.state).encode())
+                print("\n=> Turn #{} (player {})".format(self.turns, current))
+            start = time.perf_counter()
+            player.send(self._playmessage(current))
+            sent = time.perf_counter()
             try:
-                move = player.recv(self._state.__class__.buffersize()).decode()
+                move = player.recv().decode()
+                # The player lost track of the game with delta updates
+                while move == 'RESYNC':
+                    if self.__verbose:
+                        print('   Resynchronising player {}.'.format(self.__currentplayer))
+                    self._resync(self.__currentplayer)
+                    player.send(self._playmessage(self.__currentplayer))
+                    move = player.recv().decode()
+                received = time.perf_counter()
                 if self.__verbose:
                     print('   Move:', move)
-                self.applymove(move)
-                self.__turns += 1
-                self.__currentplayer = (self.__currentplayer + 1) % self.nbplayers
+                self._playmove(move)
             except InvalidMoveException as e:
                 if self.__verbose:
                     print('Invalid move:', e)
-                player.sendall('ERROR {}'.format(e).encode())
+                player.send('ERROR {}'.format(e).encode())
+                # The player gets the full state again rather than trusting its own copy
+                self._resync(current)
+            applied = time.perf_counter()
+            winner = self._state.winner()
+            checked = time.perf_counter()
             if self.__verbose:
                 print('   State:')
                 self._state.prettyprint()
-            winner = self._state.winner()
+                self._timeturn(current, start, sent, received, applied, checked, time.perf_counter())
+            else:
+                self._timeturn(current, start, sent, received, applied, checked)
+        self._logresult(winner)
         if self.__verbose:
             _printsection('Game finished')
         # Notify players about won/lost status
         if winner is not None:
             for i in range(self.nbplayers):
-                self.__players[i].sendall(('WON' if winner == i else 'LOST').encode())
+                self.__players[i].send(('WON' if winner == i else 'LOST').encode())
             if self.__verbose:
                 print(' The winner is player {}.'.format(winner))
         # Notify players that the game ended
         else:
             for player in self.__players:
-                player.sendall('END'.encode())
+                player.send('END'.encode())
+        if self.__verbose:
+            _printsection('Game ended')
+        return winner
+
+    def run(self):
+        if not self._waitplayers():
+            return
+        # Games won by each player, numbered as in the first game
+        seats = list(range(self.nbplayers))
+        wins = [0] * self.nbplayers
+        for game in range(self.__series):
+            if game > 0:
+                # The colours rotate: each player gets the number of the previous one
+                self._nextgame()
+                self.__players = self.__players[1:] + self.__players[:1]
+                seats = seats[1:] + seats[:1]
+                if not self._handshake():
+                    break
+            winner = self._gameloop()
+            if winner is not None:
+                wins[seats[winner]] += 1
+            if not self.__inseries:
+                break
         # Close the connexions with the clients
         for player in self.__players:
+            if self.__inseries:
+                player.send('BYE'.encode())
             player.close()
+        if self.__verbose and self.__inseries:
+            print(' Games won by the players of the first game: {}.'.format(wins))
+
+    async def _asyncgame(self, players):
+        '''Play one game, or a series of them, with players already connected
+        through asyncio streams.
+
+        Pre: 'players' is a list of nbplayers (reader, writer) pairs.
+        Post: The games have been played (or the session aborted if a player
+              left) and the connections with the players are closed. The
+              returned value is the list of the results of the games: the
+              winner, as given by GameState.winner but numbered by position in
+              'players', or -1 for an aborted game.
+        '''
+        async def send(i, message):
+            writemessage(players[i][1], message if isinstance(message, bytes) else message.encode())
+            await players[i][1].drain()
+
+        async def receive(i):
+            return (await readmessage(players[i][0])).decode()
+
+        connections = players
+        seats = list(range(len(players)))
+        results = []
+        try:
+            for game in range(self.__series):
+                if game > 0:
+                    self._nextgame()
+                    players = players[1:] + players[:1]
+                    seats = seats[1:] + seats[:1]
+                winner = await self._asyncplay(len(players), send, receive)
+                results.append(winner if winner in (None, -1) else seats[winner])
+                if winner == -1 or not self.__inseries:
+                    break
+            if self.__inseries:
+                for i in range(len(players)):
+                    await send(i, 'BYE')
+        except OSError:
+            results.append(-1)
+        finally:
+            for reader, writer in connections:
+                writer.close()
+        return results
+
+    async def _asyncplay(self, nbplayers, send, receive):
+        '''Play one game of _asyncgame and return its winner (-1 if a player
+        was not ready). Raises OSError if a player left.'''
+        winner = -1
+        # Notify players that the game started
+        options = []
+        for i in range(nbplayers):
+            await send(i, self._startmessage(i))
+            data = (await receive(i)).split(' ')
+            if data[0] != 'READY':
+                return -1
+            options.append(self._readyoptions(data))
+        self._startgame(options)
+        self.__currentplayer = 0
+        # Loop until the game ends with a winner or with a draw
+        while winner == -1:
+            current = self.__currentplayer
+            start = time.perf_counter()
+            await send(current, self._playmessage(current))
+            sent = time.perf_counter()
+            move = await receive(current)
+            while move == 'RESYNC':
+                self._resync(current)
+                await send(current, self._playmessage(current))
+                move = await receive(current)
+            received = time.perf_counter()
+            try:
+                self._playmove(move)
+            except InvalidMoveException as e:
+                await send(current, 'ERROR {}'.format(e))
+                self._resync(current)
+            applied = time.perf_counter()
+            winner = self._state.winner()
+            checked = time.perf_counter()
+            self._timeturn(current, start, sent, received, applied, checked)
+        self._logresult(winner)
+        # Notify players about won/lost status or that the game ended
+        for i in range(nbplayers):
+            await send(i, 'END' if winner is None else 'WON' if winner == i else 'LOST')
+        return winner
+
+
+class GameLobby:
+    '''Asyncio game server running many games at once.
+
+    Clients are accepted continuously and wait in a lobby queue. As soon as
+    enough of them are waiting, they are paired, in arrival order, into a new
+    game that runs concurrently with the others in the same event loop. Each
+    game gets its own GameServer built by 'serverfactory', and so its own state
+    (a series of games if the server is built with one).
+    '''
+    def __init__(self, serverfactory, port=5000, verbose=False):
+        self.__factory = serverfactory
+        self.__port = port
+        self.__verbose = verbose
+        server = serverfactory()
+        self.__nbplayers = server.nbplayers
+        self.__name = server.name
+        self.__queue = None
+        # Running games, kept referenced until they are done
+        self.__games = set()
+        # Stats about the lobby
+        self.started = 0
+        self.finished = 0
+
+    @property
+    def running(self):
+        return self.started - self.finished
+
+    async def _onclient(self, reader, writer):
         if self.__verbose:
-            _printsection('Game ended')
+            print(' - Client connected from {}:{} (lobby: {}).'
+                  .format(*writer.get_extra_info('peername')[:2], self.__queue.qsize() + 1))
+        await self.__queue.put((reader, writer))
+
+    async def _matchmaker(self):
+        while True:
+            players = []
+            while len(players) < self.__nbplayers:
+                reader, writer = await self.__queue.get()
+                # Skip the clients that left while waiting
+                if reader.at_eof() or writer.is_closing():
+                    writer.close()
+                else:
+                    players.append((reader, writer))
+            task = asyncio.ensure_future(self._play(players))
+            self.__games.add(task)
+            task.add_done_callback(self.__games.discard)
+
+    async def _play(self, players):
+        self.started += 1
+        number = self.started
+        if self.__verbose:
+            print(' Game #{} started ({} running).'.format(number, self.running))
+        results = None
+        try:
+            results = await self.__factory()._asyncgame(players)
+        finally:
+            # Also counted as finished when it failed, so 'running' stays right
+            self.finished += 1
+            if self.__verbose:
+                print(' Game #{} {} ({} running).'.format(
+                    number, 'failed' if results is None else ', '.join(map(_result, results)), self.running
+                ))
+
+    async def _serve(self):
+        self.__queue = asyncio.Queue()
+        server = await asyncio.start_server(self._onclient, '0.0.0.0', self.__port)
+        if self.__verbose:
+            _printsection('Starting {} lobby'.format(self.__name))
+            print(' Lobby listening on port {}, {} players per game.'.format(self.__port, self.__nbplayers))
+        matchmaker = asyncio.ensure_future(self._matchmaker())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            matchmaker.cancel()
 
     def run(self):
-        if self._waitplayers():
-            self._gameloop()
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            if self.__verbose:
+                _printsection('Lobby ended')
 
 
 class GameClient(metaclass=ABCMeta):
-    '''Abstract class representing a game client'''
-    def __init__(self, server, stateclass, verbose=False):
+    '''Abstract class representing a game client
+
+    The client accepts to play series of games over the same connection: it
+    then stays connected after each game until the server says BYE, so the
+    player keeps everything it learned from one game to the next.
+    '''
+    def __init__(self, server, stateclass, verbose=False, name=None):
         self.__stateclass = stateclass
         self.__verbose = verbose
+        # The name is announced in READY, where words starting with '+' are options
+        self.__name = None if name is None else name.replace(' ', '_').lstrip('+')
+        self.__binary = False
+        self.__delta = False
+        self.__series = False
+        # State of the game as followed with delta updates
+        self.__state = None
+        # Without server, the client is only used in-process through _nextmove
+        if server is None:
+            return
         if self.__verbose:
             _printsection('Starting game')
         addrinfos = socket.getaddrinfo(*server, socket.AF_INET, socket.SOCK_STREAM)
@@ -218,7 +729,7 @@ class GameClient(metaclass=ABCMeta):
             s.connect(addrinfos[0][4])
             if self.__verbose:
                 print(' Connected to the game server on {}:{}.'.format(*addrinfos[0][4]))
-            self.__server = s
+            self.__server = MessageSocket(s, self.__stateclass.buffersize())
             self._gameloop()
         except OSError:
             print(' Impossible to connect to the game server on {}:{}.'.format(*addrinfos[0][4]))
@@ -227,16 +738,35 @@ class GameClient(metaclass=ABCMeta):
         server = self.__server
         running = True
         while running:
-            data = server.recv(self.__stateclass.buffersize()).decode()
-            command = data[:data.index(' ')] if ' ' in data else data
+            message = server.recv()
+            self._stoppondering()
+            command, _, payload = message.partition(b' ')
+            command = command.decode()
             if command == 'START':
-                self._playernb = int(data[data.index(' '):])
-                server.sendall('READY'.encode())
+                data = payload.decode().split(' ')
+                self._playernb = int(data[0])
+                # Accept the binary states and delta updates if the server offers them
+                self.__binary = '+binary' in data and self.__stateclass.BINARY
+                self.__delta = '+delta' in data and self.__stateclass.DELTA
+                self.__series = '+series' in data
+                self.__state = None
+                self._newgame()
+                server.send(('READY' + (' ' + self.__name if self.__name else '') +
+                             (' +binary' if self.__binary else '') + (' +delta' if self.__delta else '') +
+                             (' +series' if self.__series else '')).encode())
                 if self.__verbose:
                     _printsection('Game started')
                     print("   Player's number: {}".format(self._playernb))
-            elif command == 'PLAY':
-                state = self.__stateclass.parse(data[data.index(' ')+1:])
+            elif command in ('PLAY', 'DELTA'):
+                if command == 'PLAY':
+                    self.__state = self.__stateclass.parse(payload, self.__binary)
+                elif not self._applydelta(json.loads(payload.decode())):
+                    if self.__verbose:
+                        print('   State out of sync, asking for the full state.')
+                    server.send('RESYNC'.encode())
+                    continue
+                # The followed state is kept, so the player gets a snapshot of it
+                state = self.__state.snapshot() if self.__delta else self.__state
                 if self.__verbose:
                     print("\n=> Player's turn to play")
                     print('   State:')
@@ -244,9 +774,9 @@ class GameClient(metaclass=ABCMeta):
                 move = self._nextmove(state)
                 if self.__verbose:
                     print('   Move:', move)
-                server.sendall(move.encode())
+                server.send(move.encode())
+                self._ponder(state, move)
             elif command in ('WON', 'LOST', 'END'):
-                running = False
                 if self.__verbose:
                     _printsection('Game finished')
                     if command == 'WON':
@@ -255,13 +785,60 @@ class GameClient(metaclass=ABCMeta):
                         print(' You lost the game.')
                     else:
                         print(' It is draw.')
-                    _printsection('Game ended')
+                # In a series, the next game (or BYE) follows on the same connection
+                if not self.__series:
+                    running = False
+                    if self.__verbose:
+                        _printsection('Game ended')
+                    server.close()
+            elif command == 'BYE':
+                running = False
+                if self.__verbose:
+                    _printsection('Series ended')
                 server.close()
             else:
+                data = message.decode()
                 if self.__verbose:
                     print('Specific data received:', data)
                 self._handle(data)
 
+    def _applydelta(self, delta):
+        '''Apply the moves of a DELTA message to the followed state and check
+        its checksum, if any. Return False if the state is out of sync.'''
+        if self.__state is None:
+            return False
+        try:
+            for player, move in delta['moves']:
+                self.__state.applymove(move, player)
+        except InvalidMoveException:
+            self.__state = None
+            return False
+        if delta['checksum'] is not None and self.__state.checksum(self.__binary) != delta['checksum']:
+            self.__state = None
+            return False
+        return True
+
+    def _newgame(self):
+        '''Called when a game starts, before answering READY.
+
+        Pre: -
+        Post: What the player remembers about the previous game, if any, has
+              been forgotten. What stays valid from one game to the next (like
+              search tables) may be kept.
+        '''
+        pass
+
+    def _ponder(self, state, move):
+        '''Called once 'move' has been sent as the answer to 'state', while
+        waiting for the server. It must return at once: a player that wants to
+        think during the turn of the opponent does so in another thread.'''
+        pass
+
+    def _stoppondering(self):
+        '''Called as soon as a message arrives from the server, before handling
+        it. Thinking started by _ponder must have stopped when it returns.'''
+        pass
+
     @abstractmethod
     def _handle(self, command):
         '''Handle a command.
@@ -0,0 +1,218 @@
+# gamelog.py
+# Append-only binary log of played games, with an index of their offsets.
+#
+# The log file starts with MAGIC, followed by one entry per game:
+#   - ENTRY: game id, number of moves, result (the winner, or DRAW), number of
+#     players and size in bytes of a move record;
+#   - the name of each player: its length in bytes (one byte) then its UTF-8
+#     bytes (empty for an anonymous player);
+#   - the moves, one fixed-size record each, as encoded by GameState.packmove.
+# The index file (the log path followed by '.idx') holds one INDEX record,
+# (game id, offset of the entry in the log), per game.
+
+import bisect
+import mmap
+import os
+import queue
+import struct
+import sys
+import threading
+
+MAGIC = b'GLOG\x01'
+ENTRY = struct.Struct('!QIBBB')
+INDEX = struct.Struct('!QQ')
+DRAW = 255
+
+
+class GameLog:
+    '''Writer of a game log.
+
+    Games are handed to write(), which only puts them in a queue: a
+    background thread encodes them, appends them to the log and the index,
+    and flushes both files whenever the queue is empty. Game ids follow the
+    ones already in the index, starting at 0.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.indexpath = path + '.idx'
+        self.__nextid = 0
+        if os.path.exists(self.indexpath):
+            size = os.path.getsize(self.indexpath)
+            if size >= INDEX.size:
+                with open(self.indexpath, 'rb') as index:
+                    index.seek(size - size % INDEX.size - INDEX.size)
+                    self.__nextid = INDEX.unpack(index.read(INDEX.size))[0] + 1
+        self.__queue = queue.Queue()
+        self.__thread = threading.Thread(target=self._run, daemon=True)
+        self.__thread.start()
+
+    def write(self, stateclass, names, winner, moves):
+        '''Log a finished game.
+
+        Pre: 'stateclass' implements packmove; 'names' holds the name (or None)
+             of each player; 'winner' is as given by GameState.winner and
+             'moves' is the list of the (player, move) applied, in order.
+        Post: The game will be written by the background thread.
+        '''
+        self.__queue.put((stateclass, names, winner, moves))
+
+    def close(self):
+        '''Write the games still in the queue and stop the background thread.'''
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def _encode(self, gameid, stateclass, names, winner, moves):
+        data = bytearray(ENTRY.pack(gameid, len(moves), DRAW if winner is None else winner,
+                                    len(names), stateclass.MOVESIZE))
+        for name in names:
+            name = (name or '').encode()[:255]
+            data.append(len(name))
+            data += name
+        for player, move in moves:
+            data += stateclass.packmove(move, player)
+        return data
+
+    def _run(self):
+        with open(self.path, 'ab') as log, open(self.indexpath, 'ab') as index:
+            if log.tell() == 0:
+                log.write(MAGIC)
+            while True:
+                game = self.__queue.get()
+                if game is None:
+                    break
+                # A game that cannot be encoded is reported and left out, the
+                # thread goes on with the next ones
+                try:
+                    data = self._encode(self.__nextid, *game)
+                except Exception as e:
+                    print('{}: game not logged ({}: {})'.format(self.path, type(e).__name__, e), file=sys.stderr)
+                else:
+                    index.write(INDEX.pack(self.__nextid, log.tell()))
+                    log.write(data)
+                    self.__nextid += 1
+                if self.__queue.empty():
+                    log.flush()
+                    index.flush()
+
+
+class LoggedGame:
+    '''A game read from a log: its id, the names of the players, the winner
+    (None for a draw) and the packed records of its moves.'''
+    __slots__ = ('gameid', 'names', 'winner', 'movesize', 'records')
+
+    def __init__(self, gameid, names, winner, movesize, records):
+        self.gameid = gameid
+        self.names = names
+        self.winner = winner
+        self.movesize = movesize
+        self.records = records
+
+    def __len__(self):
+        return len(self.records) // self.movesize
+
+    def __iter__(self):
+        '''Iterate over the packed moves (see GameState.packmove).'''
+        size = self.movesize
+        records = self.records
+        for offset in range(0, len(records), size):
+            yield records[offset:offset + size]
+
+    def moves(self, stateclass):
+        '''Iterate over the (move, player) pairs, as unpacked by 'stateclass'.'''
+        for record in self:
+            yield stateclass.unpackmove(record)
+
+
+class _Map:
+    '''Read-only memory map of a whole file (an empty file maps to b'').'''
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+class _IndexIds:
+    '''Sequence of the game ids of a mapped index, for bisect.'''
+    def __init__(self, data):
+        self.__data = data
+
+    def __len__(self):
+        return len(self.__data) // INDEX.size
+
+    def __getitem__(self, position):
+        return INDEX.unpack_from(self.__data, position * INDEX.size)[0]
+
+
+class GameLogReader:
+    '''Reader of a game log, mapped in memory rather than loaded.
+
+    Iterating over the reader reads the games in the order of the log; game()
+    finds one game through the index. A game still being written when the log
+    was opened (truncated entry) is left out.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.__log = _Map(path)
+        if self.__log.data[:len(MAGIC)] != MAGIC:
+            self.__log.close()
+            raise ValueError('{} is not a game log'.format(path))
+        self.__index = _Map(path + '.idx') if os.path.exists(path + '.idx') else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def close(self):
+        self.__log.close()
+        if self.__index is not None:
+            self.__index.close()
+
+    def __iter__(self):
+        offset = len(MAGIC)
+        while True:
+            game, offset = self._read(offset)
+            if game is None:
+                return
+            yield game
+
+    def game(self, gameid):
+        '''Return the game 'gameid', found through the index.
+
+        Raises KeyError: If the index does not know 'gameid'.
+        '''
+        index = b'' if self.__index is None else self.__index.data
+        # The ids grow along the index, so it can be searched by bisection
+        ids = _IndexIds(index)
+        position = bisect.bisect_left(ids, gameid)
+        if position == len(ids) or ids[position] != gameid:
+            raise KeyError(gameid)
+        game = self._read(INDEX.unpack_from(index, position * INDEX.size)[1])[0]
+        if game is None:
+            raise KeyError(gameid)
+        return game
+
+    def _read(self, offset):
+        '''Return the game whose entry starts at 'offset' and the offset of the
+        next entry, or (None, offset) at the end of the log.'''
+        data = self.__log.data
+        if offset + ENTRY.size > len(data):
+            return None, offset
+        gameid, count, result, nbplayers, movesize = ENTRY.unpack_from(data, offset)
+        offset += ENTRY.size
+        names = []
+        for i in range(nbplayers):
+            if offset >= len(data):
+                return None, offset
+            length = data[offset]
+            names.append(data[offset + 1:offset + 1 + length].decode() or None)
+            offset += 1 + length
+        end = offset + count * movesize
+        if end > len(data):
+            return None, offset
+        return LoggedGame(gameid, names, None if result == DRAW else result, movesize, data[offset:end]), end
@@ -0,0 +1,334 @@
+# search.py
+# Negamax search with alpha-beta pruning for two-player game states.
+#
+# The searched states must provide:
+#   - turn: the number of the player to move (0 or 1);
+#   - moves(): the legal moves of the player to move;
+#   - apply(move): play a legal move in place and return an undo record;
+#   - undo(record): restore the state as it was before the matching apply;
+#   - winner(): same contract as GameState.winner;
+#   - hash: a key identifying the position (only used with a transposition table).
+
+import copy
+import threading
+import time
+
+INFINITY = float('inf')
+WIN = 1000000
+DEFAULT_DEPTH = 3
+MAX_DEPTH = 64
+# Number of nodes between two looks at the clock (must be a power of two)
+CLOCK_INTERVAL = 1024
+DEFAULT_TT_SIZE = 1 << 18
+
+# Bound types of the transposition table entries
+EXACT, LOWER, UPPER = 0, 1, 2
+
+
+class _Timeout(Exception):
+    '''Raised inside the search when the think time is over.'''
+
+
+def reservedelta(state, player):
+    '''Default evaluation: spheres left in the reserve of 'player' minus the
+    ones left in the reserve of the opponent.'''
+    reserve = state.reserve
+    return reserve[player] - reserve[1 - player]
+
+
+def _tott(score, ply):
+    '''Make a win/loss score relative to the node before storing it.'''
+    if score >= WIN - MAX_DEPTH:
+        return score + ply
+    if score <= MAX_DEPTH - WIN:
+        return score - ply
+    return score
+
+
+def _fromtt(score, ply):
+    if score >= WIN - MAX_DEPTH:
+        return score - ply
+    if score <= MAX_DEPTH - WIN:
+        return score + ply
+    return score
+
+
+def _ordered(first, moves):
+    yield first
+    for move in moves:
+        if move != first:
+            yield move
+
+
+class TranspositionTable:
+    '''Bounded table of search results indexed by position hash.
+
+    The table has 'size' slots and a position goes to slot hash % size. A new
+    entry replaces the one in its slot if the slot is empty, holds the same
+    position, was written during an older search, or was searched less deep.
+    '''
+    def __init__(self, size=DEFAULT_TT_SIZE):
+        self.__size = size
+        self.__slots = [None] * size
+        self.__generation = 0
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def hitrate(self):
+        return self.hits / self.probes if self.probes else 0.0
+
+    def newsearch(self):
+        '''Age the current entries so that the next search may replace them.'''
+        self.__generation += 1
+
+    def clear(self):
+        self.__slots = [None] * self.__size
+        self.probes = self.hits = self.stores = 0
+
+    def probe(self, key):
+        '''Return the (depth, bound, score, move) stored for 'key', or None.'''
+        self.probes += 1
+        entry = self.__slots[key % self.__size]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry[1:5]
+        return None
+
+    def store(self, key, depth, bound, score, move):
+        slot = key % self.__size
+        entry = self.__slots[slot]
+        if entry is None or entry[0] == key or entry[5] != self.__generation or entry[1] <= depth:
+            self.__slots[slot] = (key, depth, bound, score, move, self.__generation)
+            self.stores += 1
+
+
+class Negamax:
+    '''Negamax search with alpha-beta pruning.
+
+    'evaluate(state, player)' scores a non final state from the point of view
+    of 'player'; higher is better. Without 'thinktime' every search goes
+    'depth' plies deep (3 by default). With a 'thinktime' in seconds, bestmove
+    deepens iteratively up to 'depth' (unbounded by default) and stops when
+    the time is over. Positions already searched are looked up in 'tt', a
+    TranspositionTable (None to search without one).
+    '''
+    def __init__(self, depth=None, evaluate=reservedelta, thinktime=None, tt=None):
+        if depth is None:
+            depth = DEFAULT_DEPTH if thinktime is None else MAX_DEPTH
+        self.depth = depth
+        self.evaluate = evaluate
+        self.thinktime = thinktime
+        self.tt = tt
+        self.nodes = 0
+        self.completeddepth = 0
+        self.__deadline = None
+        self.__stop = None
+
+    def search(self, state, depth=None):
+        '''Search the best move for the player to move in 'state'.
+
+        Pre: 'state' is not a final state.
+        Post: The returned value is a (score, move) pair where 'move' is None
+              if the player to move has no legal move. 'state' is left unchanged.
+        '''
+        self.nodes = 0
+        self.__deadline = None
+        if self.tt is not None:
+            self.tt.newsearch()
+        depth = self.depth if depth is None else depth
+        score, move = self._root(copy.deepcopy(state), depth, None)
+        self.completeddepth = depth
+        return score, move
+
+    def iterate(self, state, thinktime, maxdepth=None, stop=None):
+        '''Search 1, 2, 3... plies deep until 'thinktime' seconds are elapsed
+        (None for no time limit) or until the threading.Event 'stop' is set.
+
+        Pre: 'state' is not a final state.
+        Post: The returned value is the (score, move) pair of the deepest search
+              that completed in time (see completeddepth). If not even the first
+              ply could be searched, the first legal move is returned with a
+              None score.
+        '''
+        self.nodes = 0
+        self.completeddepth = 0
+        if self.tt is not None:
+            self.tt.newsearch()
+        self.__deadline = None if thinktime is None else time.perf_counter() + thinktime
+        self.__stop = stop
+        maxdepth = self.depth if maxdepth is None else maxdepth
+        # The search works on a copy: an interrupted search leaves it dirty
+        work = copy.deepcopy(state)
+        score, move = None, None
+        try:
+            for depth in range(1, maxdepth + 1):
+                score, move = self._root(work, depth, move)
+                self.completeddepth = depth
+                if move is None or abs(score) >= WIN - MAX_DEPTH:
+                    break
+        except _Timeout:
+            pass
+        finally:
+            self.__deadline = None
+            self.__stop = None
+        if move is None and self.completeddepth == 0:
+            move = next(iter(state.moves()), None)
+        return score, move
+
+    def bestmove(self, state):
+        if self.thinktime is None:
+            return self.search(state)[1]
+        return self.iterate(state, self.thinktime)[1]
+
+    def stats(self):
+        '''Describe the last search in one line.'''
+        line = 'depth {}, {} nodes'.format(self.completeddepth, self.nodes)
+        if self.tt is not None:
+            line += ', TT hit rate {:.1%} ({} probes)'.format(self.tt.hitrate, self.tt.probes)
+        return line
+
+    def _root(self, state, depth, firstmove):
+        moves = list(state.moves())
+        # Search the best move of the previous iteration first
+        if firstmove is not None and firstmove in moves:
+            moves.remove(firstmove)
+            moves.insert(0, firstmove)
+        alpha, beta = -INFINITY, INFINITY
+        bestscore, bestmove = -INFINITY, None
+        for move in moves:
+            record = state.apply(move)
+            score = -self._negamax(state, depth - 1, -beta, -alpha, 1)
+            state.undo(record)
+            if score > bestscore:
+                bestscore, bestmove = score, move
+                alpha = max(alpha, score)
+        if bestmove is None:
+            return self.evaluate(state, state.turn), None
+        return bestscore, bestmove
+
+    def _negamax(self, state, depth, alpha, beta, ply):
+        self.nodes += 1
+        if not self.nodes & (CLOCK_INTERVAL - 1):
+            if self.__deadline is not None and time.perf_counter() > self.__deadline:
+                raise _Timeout()
+            if self.__stop is not None and self.__stop.is_set():
+                raise _Timeout()
+        winner = state.winner()
+        if winner != -1:
+            if winner is None:
+                return 0
+            # Prefer the quickest win and the slowest loss
+            return WIN - ply if winner == state.turn else ply - WIN
+        if depth <= 0:
+            return self.evaluate(state, state.turn)
+        tt = self.tt
+        moves = state.moves()
+        if tt is not None:
+            alphaorig = alpha
+            entry = tt.probe(state.hash)
+            if entry is not None:
+                ttdepth, bound, score, ttmove = entry
+                if ttdepth >= depth:
+                    score = _fromtt(score, ply)
+                    if bound == EXACT:
+                        return score
+                    if bound == LOWER:
+                        alpha = max(alpha, score)
+                    else:
+                        beta = min(beta, score)
+                    if alpha >= beta:
+                        return score
+                # Search the best move found last time first
+                if ttmove is not None:
+                    moves = _ordered(ttmove, moves)
+        best, bestmove = -INFINITY, None
+        for move in moves:
+            record = state.apply(move)
+            score = -self._negamax(state, depth - 1, -beta, -alpha, ply + 1)
+            state.undo(record)
+            if score > best:
+                best, bestmove = score, move
+                if best > alpha:
+                    alpha = best
+                    if alpha >= beta:
+                        break
+        if best == -INFINITY:
+            return self.evaluate(state, state.turn)
+        if tt is not None:
+            bound = UPPER if best <= alphaorig else LOWER if best >= beta else EXACT
+            tt.store(state.hash, depth, bound, _tott(best, ply), bestmove)
+        return best
+
+
+class Ponderer:
+    '''Search with 'engine', a Negamax, while the opponent thinks.
+
+    start() is given the position left to the opponent. A background thread
+    predicts the reply of the opponent, then searches the position that reply
+    leads to, filling the transposition table of the engine on the way. stop()
+    interrupts it; if the position then given to bestmove is the predicted one
+    and was searched deep enough, the pondered move is played at once.
+    The engine must not be used by anyone else between start() and stop().
+    '''
+    def __init__(self, engine):
+        self.engine = engine
+        self.__thread = None
+        self.__stop = None
+        # Predicted position (as its hash) and result of its search
+        self.__prediction = None
+        self.__result = None
+        self.hits = 0
+        self.misses = 0
+
+    def start(self, state):
+        self.stop()
+        self.__prediction = self.__result = None
+        if state.winner() != -1:
+            return
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self._run, args=(copy.deepcopy(state), self.__stop), daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+
+    def _run(self, state, stop):
+        engine = self.engine
+        # The opponent is expected to play what the engine would play in his place
+        reply = engine.iterate(state, engine.thinktime, engine.depth, stop)[1]
+        if stop.is_set() or engine.completeddepth == 0 or reply is None:
+            return
+        state.apply(reply)
+        self.__prediction = state.hash
+        if state.winner() != -1:
+            return
+        score, move = engine.iterate(state, None, engine.depth, stop)
+        if engine.completeddepth > 0:
+            self.__result = (engine.completeddepth, score, move)
+
+    def bestmove(self, state):
+        '''Stop pondering and return the best move in 'state', reusing the
+        pondered search when 'state' was predicted.'''
+        self.stop()
+        engine = self.engine
+        if self.__prediction is not None:
+            if self.__prediction == state.hash:
+                self.hits += 1
+                result = self.__result
+                # Without think time, a search as deep as the usual one is enough
+                if result is not None and engine.thinktime is None and result[0] >= engine.depth:
+                    engine.completeddepth = result[0]
+                    return result[2]
+            else:
+                self.misses += 1
+            self.__prediction = None
+        return engine.bestmove(state)
@@ -8,16 +8,181 @@ import argparse
 import socket
 import sys
 import json
-import copy
+import functools
 import random
 
 from lib import game
+from lib import gamelog
+
+
+# Les 30 places de la pyramide sont numérotées étage par étage et ligne par ligne :
+# l'étage 0 occupe les bits 0 à 15, l'étage 1 les bits 16 à 24, l'étage 2 les
+# bits 25 à 28 et le sommet le bit 29.
+LAYEROFFSET = (0, 16, 25, 29)
+NBCELLS = 30
+FULL = (1 << NBCELLS) - 1
+# Octets de la clé empaquetée (2 x 30 bits de plateau, 2 x 4 bits de réserve et le tour)
+KEYSIZE = 9
+CELLS = tuple(
+    (layer, row, column)
+    for layer in range(4)
+    for row in range(4 - layer)
+    for column in range(4 - layer)
+)
+LAYER = tuple(cell[0] for cell in CELLS)
+
+
+def cellindex(layer, row, column):
+    '''Retourne le numéro du bit qui correspond à une place de la pyramide'''
+    return LAYEROFFSET[layer] + row * (4 - layer) + column
+
+
+# Un coup tient dans un entier : bit 0 le type (PLACE ou MOVE), bits 1 à 5 la
+# place de départ, bits 6 à 10 la place d'arrivée, bits 11 et 12 le nombre de
+# billes retirées, bits 13 à 17 et 18 à 22 les places retirées.
+PLACE, MOVE = 0, 1
+
+
+def encodemove(move):
+    '''Code un coup du protocole (dictionnaire) dans un entier'''
+    code = cellindex(*move['to']) << 6
+    if move['move'] == 'move':
+        code |= MOVE | cellindex(*move['from']) << 1
+    removes = move.get('remove') or ()
+    code |= len(removes) << 11
+    for i, coord in enumerate(removes):
+        code |= cellindex(*coord) << 13 + 5 * i
+    return code
+
+
+def decodemove(code):
+    '''Retrouve le coup du protocole (dictionnaire) codé dans un entier'''
+    if code & MOVE:
+        move = {'move': 'move', 'from': list(CELLS[code >> 1 & 31])}
+    else:
+        move = {'move': 'place'}
+    move['to'] = list(CELLS[code >> 6 & 31])
+    count = code >> 11 & 3
+    if count > 0:
+        move['remove'] = [list(CELLS[code >> 13 + 5 * i & 31]) for i in range(count)]
+    return move
+
+
+class Move(int):
+    '''Coup codé dans un entier (voir encodemove), utilisable tel quel par
+    apply, qui donne aussi accès à ses places et à son JSON du protocole'''
+
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, move):
+        '''Crée un coup à partir de son JSON du protocole'''
+        return cls(encodemove(json.loads(move)))
+
+    @property
+    def kind(self):
+        return 'move' if self & MOVE else 'place'
+
+    @property
+    def source(self):
+        '''Place de départ d'un déplacement, None pour un placement'''
+        return CELLS[self >> 1 & 31] if self & MOVE else None
+
+    @property
+    def to(self):
+        return CELLS[self >> 6 & 31]
+
+    @property
+    def removed(self):
+        return tuple(CELLS[self >> 13 + 5 * i & 31] for i in range(self >> 11 & 3))
+
+    def todict(self):
+        return decodemove(self)
+
+    def __str__(self):
+        return json.dumps(decodemove(self))
+
+    def __repr__(self):
+        return 'Move({})'.format(self)
+
+
+def _buildgeometry():
+    '''Calcule une fois pour toutes les voisinages de chaque place'''
+    supports = [0] * NBCELLS
+    resting = [0] * NBCELLS
+    squares = []
+    cellsquares = [[] for i in range(NBCELLS)]
+    for index, (layer, row, column) in enumerate(CELLS):
+        if layer > 0:
+            for drow, dcolumn in ((0, 0), (1, 0), (1, 1), (0, 1)):
+                below = cellindex(layer - 1, row + drow, column + dcolumn)
+                supports[index] |= 1 << below
+                resting[below] |= 1 << index
+        if layer < 3 and row < 3 - layer and column < 3 - layer:
+            square = 0
+            for drow, dcolumn in ((0, 0), (1, 0), (1, 1), (0, 1)):
+                square |= 1 << cellindex(layer, row + drow, column + dcolumn)
+            squares.append(square)
+    for square in squares:
+        for index in range(NBCELLS):
+            if square >> index & 1:
+                cellsquares[index].append(square)
+    return tuple(supports), tuple(resting), tuple(squares), tuple(map(tuple, cellsquares))
+
+
+# SUPPORTS[i]: les 4 places sous i, RESTING[i]: les places qui reposent sur i,
+# SQUARES: les 14 carrés 2x2, CELLSQUARES[i]: les carrés qui contiennent i
+SUPPORTS, RESTING, SQUARES, CELLSQUARES = _buildgeometry()
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def threatmask(mine, theirs):
+    '''Places vides où une bille de plus complète un carré de mine (les
+    masques de billes des deux joueurs). Mis en cache par paire de masques.'''
+    mask = 0
+    for square in SQUARES:
+        rest = square & ~mine
+        # Une seule place du carré manque et l'adversaire ne l'occupe pas
+        if rest and not rest & (rest - 1) and not rest & theirs:
+            mask |= rest
+    return mask
+
+
+def squarethreats(state, player):
+    '''Évaluation pour search.Negamax : la différence des réserves, plus une
+    demi-bille par place où player complète un carré, moins une demi-bille par
+    place où l'adversaire le fait (en entiers, tout est compté double)'''
+    reserve = state.reserve
+    return (2 * (reserve[player] - reserve[1 - player]) +
+            state.threatcount(player) - state.threatcount(1 - player))
+
+
+# Clés de Zobrist : une par (joueur, place), par (joueur, taille de réserve) et
+# une pour le tour. Le générateur est initialisé avec une graine fixe pour que
+# toutes les instances calculent les mêmes hash.
+_zobristrandom = random.Random(20170428)
+ZOBRIST = tuple(tuple(_zobristrandom.getrandbits(64) for index in range(NBCELLS)) for player in range(2))
+ZOBRISTRESERVE = tuple(tuple(_zobristrandom.getrandbits(64) for count in range(16)) for player in range(2))
+ZOBRISTTURN = _zobristrandom.getrandbits(64)
 
 
 class PylosState(game.GameState):
-    '''Class representing a state for the Pylos game.'''
+    '''Class representing a state for the Pylos game.
+
+    The board is packed as one 30-bit integer per player (bit cellindex(...)
+    is set when the player has a sphere there). The JSON 'visible' view is
+    rebuilt from these masks on demand, so it must not be modified in place.
+    '''
+    BINARY = True
+    DELTA = True
+    # Un coup enregistré tient sur 3 octets : son code (23 bits) et le joueur
+    MOVESIZE = 3
 
     def __init__(self, initialstate=None):
+        self._board = [0, 0]
+        self._reserve = [15, 15]
+        self._turn = 0
+        self._hash = 0
 
         if initialstate == None:
             # define a layer of the board
@@ -39,15 +204,172 @@ class PylosState(game.GameState):
 
         super().__init__(initialstate)
 
-    def get(self, layer, row, column):
-        '''Permet de savoir si les coord sont bonnes et si la place est libre'''
-        if layer < 0 or row < 0 or column < 0:
-            raise game.InvalidMoveException('The position ({}) is outside of the board'.format([layer, row, column]))
+    def __deepcopy__(self, memo):
+        state = self.__class__.__new__(self.__class__)
+        state._board = list(self._board)
+        state._reserve = list(self._reserve)
+        state._turn = self._turn
+        state._hash = self._hash
+        return state
+
+    @property
+    def _state(self):
+        return {'visible': self.visible, 'hidden': None}
+
+    @_state.setter
+    def _state(self, state):
+        visible = state['visible']
+        board = [0, 0]
+        for index, (layer, row, column) in enumerate(CELLS):
+            value = visible['board'][layer][row][column]
+            if value is not None:
+                board[value] |= 1 << index
+        self._board = board
+        self._reserve = list(visible['reserve'])
+        self._turn = visible['turn']
+        self._hash = self._zobrist()
+
+    @property
+    def visible(self):
+        '''Reconstruit la vue JSON (plateau en listes, réserves et tour)'''
+        light, dark = self._board
+        board = []
+        index = 0
+        for layer in range(4):
+            matrix = []
+            for row in range(4 - layer):
+                line = []
+                for column in range(4 - layer):
+                    bit = 1 << index
+                    line.append(0 if light & bit else 1 if dark & bit else None)
+                    index += 1
+                matrix.append(line)
+            board.append(matrix)
+        return {
+            'board': board,
+            'reserve': list(self._reserve),
+            'turn': self._turn
+        }
+
+    @property
+    def turn(self):
+        return self._turn
+
+    @property
+    def board(self):
+        '''Plateau en lecture seule : les masques des billes des deux joueurs'''
+        return tuple(self._board)
+
+    @property
+    def reserve(self):
+        return tuple(self._reserve)
+
+    @property
+    def key(self):
+        '''Etat complet empaqueté dans un seul entier (voir fromkey)'''
+        return (self._board[0] | self._board[1] << 30 | self._reserve[0] << 60 |
+                self._reserve[1] << 64 | self._turn << 68)
+
+    @classmethod
+    def fromkey(cls, key):
+        '''Recrée un état à partir de sa clé empaquetée'''
+        state = cls.__new__(cls)
+        state._board = [key & FULL, key >> 30 & FULL]
+        state._reserve = [key >> 60 & 15, key >> 64 & 15]
+        state._turn = key >> 68 & 1
+        state._hash = state._zobrist()
+        return state
+
+    def serialize(self, binary=False):
+        '''En binaire, l'état est sa clé empaquetée sur KEYSIZE octets'''
+        if binary:
+            return self.key.to_bytes(KEYSIZE, 'big')
+        return super().serialize()
+
+    @classmethod
+    def parse(cls, state, binary=False):
+        if binary:
+            if len(state) != KEYSIZE:
+                raise ValueError('binary state must be {} bytes long'.format(KEYSIZE))
+            return cls.fromkey(int.from_bytes(state, 'big'))
+        return super().parse(state)
+
+    def snapshot(self):
+        return PylosSnapshot._freeze(self)
+
+    @classmethod
+    def packmove(cls, move, player):
+        return (encodemove(json.loads(move)) | player << 23).to_bytes(3, 'big')
+
+    @classmethod
+    def unpackmove(cls, data):
+        value = int.from_bytes(data, 'big')
+        return Move(value & (1 << 23) - 1), value >> 23
+
+    def applymove(self, move, player):
+        '''Joue un coup reçu en JSON, comme le fait le serveur'''
         try:
-            # return None si vide, 1 ou 0 en fonction du joueur
-            return self._state['visible']['board'][layer][row][column]
-        except:
+            self.update(json.loads(move), player)
+        except json.JSONDecodeError:
+            raise game.InvalidMoveException('move must be valid JSON string: {}'.format(move))
+
+    @property
+    def hash(self):
+        '''Hash de Zobrist de l'état, tenu à jour à chaque modification'''
+        return self._hash
+
+    def _zobrist(self):
+        '''Calcule le hash de Zobrist complet de l'état'''
+        value = ZOBRISTTURN if self._turn else 0
+        for player in range(2):
+            value ^= ZOBRISTRESERVE[player][self._reserve[player]]
+            for index in range(NBCELLS):
+                if self._board[player] >> index & 1:
+                    value ^= ZOBRIST[player][index]
+        return value
+
+    def _index(self, layer, row, column):
+        index = self._cell((layer, row, column))
+        if index is None:
             raise game.InvalidMoveException('The position ({}) is outside of the board'.format([layer, row, column]))
+        return index
+
+    def _cell(self, coord):
+        '''Numéro de la place coord, None si ce ne sont pas des coordonnées du plateau'''
+        if not isinstance(coord, (list, tuple)) or len(coord) != 3:
+            return None
+        layer, row, column = coord
+        if not (isinstance(layer, int) and isinstance(row, int) and isinstance(column, int)):
+            return None
+        if layer < 0 or row < 0 or column < 0 or layer > 3 or row > 3 - layer or column > 3 - layer:
+            return None
+        return LAYEROFFSET[layer] + row * (4 - layer) + column
+
+    def isplaceable(self, layer, row, column):
+        '''Comme validPosition (place libre et stable), sans exception'''
+        index = self._cell((layer, row, column))
+        if index is None:
+            return False
+        occupied = self._board[0] | self._board[1]
+        return not occupied >> index & 1 and not SUPPORTS[index] & ~occupied
+
+    def ismovable(self, layer, row, column):
+        '''Comme canMove (place occupée, rien ne repose dessus), sans exception'''
+        index = self._cell((layer, row, column))
+        if index is None:
+            return False
+        occupied = self._board[0] | self._board[1]
+        return bool(occupied >> index & 1) and not RESTING[index] & occupied
+
+    def get(self, layer, row, column):
+        '''Permet de savoir si les coord sont bonnes et si la place est libre'''
+        # return None si vide, 1 ou 0 en fonction du joueur
+        bit = 1 << self._index(layer, row, column)
+        if self._board[0] & bit:
+            return 0
+        if self._board[1] & bit:
+            return 1
+        return None
 
     def safeGet(self, layer, row, column):
         try:
@@ -55,61 +377,132 @@ class PylosState(game.GameState):
         except game.InvalidMoveException:
             return None
 
+    def put(self, coord, value):
+        '''Pose une bille (ou vide la place si value vaut None) sans aucune vérification'''
+        index = cellindex(*coord)
+        bit = 1 << index
+        for player in range(2):
+            if self._board[player] & bit:
+                self._board[player] &= ~bit
+                self._hash ^= ZOBRIST[player][index]
+        if value is not None:
+            self._board[value] |= bit
+            self._hash ^= ZOBRIST[value][index]
+
     def validPosition(self, layer, row, column):
         '''permet de savoir si la place est libre et si elle est stable'''
-        if self.get(layer, row, column) != None:
+        index = self._index(layer, row, column)
+        occupied = self._board[0] | self._board[1]
+        if occupied >> index & 1:
             raise game.InvalidMoveException('The position ({}) is not free'.format([layer, row, column]))
 
-        if layer > 0:
-            if (
-                                    self.get(layer - 1, row, column) == None or
-                                    self.get(layer - 1, row + 1, column) == None or
-                                self.get(layer - 1, row + 1, column + 1) == None or
-                            self.get(layer - 1, row, column + 1) == None
-            ):
-                raise game.InvalidMoveException('The position ({}) is not stable'.format([layer, row, column]))
+        if SUPPORTS[index] & ~occupied:
+            raise game.InvalidMoveException('The position ({}) is not stable'.format([layer, row, column]))
 
     def canMove(self, layer, row, column):
         '''Verifie si la place est vide, et s'il y a une piéce au dessus'''
-        if self.get(layer, row, column) == None:
+        index = self._index(layer, row, column)
+        occupied = self._board[0] | self._board[1]
+        if not occupied >> index & 1:
             raise game.InvalidMoveException('The position ({}) is empty'.format([layer, row, column]))
 
-        if layer < 3:
-            if (
-                                    self.safeGet(layer + 1, row, column) != None or
-                                    self.safeGet(layer + 1, row - 1, column) != None or
-                                self.safeGet(layer + 1, row - 1, column - 1) != None or
-                            self.safeGet(layer + 1, row, column - 1) != None
-            ):
-                raise game.InvalidMoveException('The position ({}) is not movable'.format([layer, row, column]))
+        if RESTING[index] & occupied:
+            raise game.InvalidMoveException('The position ({}) is not movable'.format([layer, row, column]))
 
     def createSquare(self, coord):
         '''Regarde si on a créé une carré'''
-        layer, row, column = tuple(coord)
-
-        def isSquare(layer, row, column):
-            if (
-                                    self.safeGet(layer, row, column) != None and
-                                    self.safeGet(layer, row + 1, column) == self.safeGet(layer, row, column) and
-                                self.safeGet(layer, row + 1, column + 1) == self.safeGet(layer, row, column) and
-                            self.safeGet(layer, row, column + 1) == self.safeGet(layer, row, column)
-            ):
+        light, dark = self._board
+        for square in CELLSQUARES[self._index(*coord)]:
+            if light & square == square or dark & square == square:
                 return True
-            return False
+        return False
 
-        if (
-                            isSquare(layer, row, column) or
-                            isSquare(layer, row - 1, column) or
-                        isSquare(layer, row - 1, column - 1) or
-                    isSquare(layer, row, column - 1)
-        ):
-            return True
+    def completessquare(self, coord, player):
+        '''Regarde si une bille de player posée en coord complète un de ses carrés'''
+        index = self._index(*coord)
+        mine = self._board[player] | 1 << index
+        for square in CELLSQUARES[index]:
+            if mine & square == square:
+                return True
         return False
 
+    def threats(self, player):
+        '''Liste les places vides où player complète un carré en y posant une bille'''
+        mask = threatmask(self._board[player], self._board[1 - player])
+        return [CELLS[index] for index in range(NBCELLS) if mask >> index & 1]
+
+    def threatcount(self, player):
+        '''Nombre de places où player complète un carré en y posant une bille'''
+        return bin(threatmask(self._board[player], self._board[1 - player])).count('1')
+
+    def placements(self):
+        '''Liste les places libres et stables, où l'on peut poser une bille'''
+        occupied = self._board[0] | self._board[1]
+        return [CELLS[index] for index in range(NBCELLS)
+                if not occupied >> index & 1 and not SUPPORTS[index] & ~occupied]
+
+    def movables(self, player):
+        '''Liste les billes du joueur sur lesquelles aucune autre bille ne repose'''
+        mine = self._board[player]
+        occupied = self._board[0] | self._board[1]
+        return [CELLS[index] for index in range(NBCELLS)
+                if mine >> index & 1 and not RESTING[index] & occupied]
+
+    def moves(self):
+        '''Génère un à un tous les coups valides du joueur dont c'est le tour, codés
+        en entiers (voir encodemove), sans doublon : placements, déplacements vers
+        un étage supérieur, et toutes les variantes avec retrait d'une ou deux
+        billes quand le coup forme un carré'''
+        player = self._turn
+        mine = self._board[player]
+        occupied = self._board[0] | self._board[1]
+        free = [index for index in range(NBCELLS)
+                if not occupied >> index & 1 and not SUPPORTS[index] & ~occupied]
+        if self._reserve[player] > 0:
+            for to in free:
+                bit = 1 << to
+                yield from self._withremovals(to << 6, to, mine | bit, occupied | bit)
+        # La bille du sommet ne peut jamais monter
+        for source in range(NBCELLS - 1):
+            if mine >> source & 1 and not RESTING[source] & occupied:
+                left = ~(1 << source)
+                for to in free:
+                    # La bille déplacée ne peut pas être un support de sa nouvelle place
+                    if LAYER[to] > LAYER[source] and not SUPPORTS[to] >> source & 1:
+                        bit = 1 << to
+                        yield from self._withremovals(MOVE | source << 1 | to << 6, to,
+                                                      mine & left | bit, occupied & left | bit)
+
+    def legalmoves(self):
+        '''Liste les coups valides (voir moves) en objets Move'''
+        return [Move(code) for code in self.moves()]
+
+    def _withremovals(self, code, to, mine, occupied):
+        '''Le coup lui-même, suivi de ses variantes avec retrait s'il forme un carré
+        (mine et occupied décrivent le plateau une fois le coup joué)'''
+        yield code
+        for square in CELLSQUARES[to]:
+            if mine & square == square:
+                break
+        else:
+            return
+        removable = [index for index in range(NBCELLS)
+                     if mine >> index & 1 and not RESTING[index] & occupied]
+        for first in removable:
+            yield code | 1 << 11 | first << 13
+        for first in removable:
+            left = occupied & ~(1 << first)
+            for second in range(NBCELLS):
+                if second != first and mine >> second & 1 and not RESTING[second] & left:
+                    # Une paire retirable dans les deux ordres n'est donnée qu'une fois
+                    if second < first and second in removable:
+                        continue
+                    yield code | 2 << 11 | first << 13 | second << 18
+
     def set(self, coord, value):
         layer, row, column = tuple(coord)
         self.validPosition(layer, row, column)
-        self._state['visible']['board'][layer][row][column] = value
+        self.put(coord, value)
 
     def remove(self, coord, player):
         layer, row, column = tuple(coord)
@@ -117,46 +510,145 @@ class PylosState(game.GameState):
         sphere = self.get(layer, row, column)
         if sphere != player:
             raise game.InvalidMoveException('not your sphere')
-        self._state['visible']['board'][layer][row][column] = None
+        self.put(coord, None)
+
+    def _takeerror(self, coord, player, mine, occupied):
+        '''Raison pour laquelle player ne peut pas reprendre la bille en coord
+        (mine et occupied décrivent le plateau), None s'il le peut'''
+        index = self._cell(coord)
+        if index is None:
+            return 'The position ({}) is outside of the board'.format(coord)
+        if not occupied >> index & 1:
+            return 'The position ({}) is empty'.format(coord)
+        if RESTING[index] & occupied:
+            return 'The position ({}) is not movable'.format(coord)
+        if not mine >> index & 1:
+            return 'not your sphere'
+        return None
+
+    def _puterror(self, coord, occupied):
+        '''Raison pour laquelle on ne peut pas poser de bille en coord, None si on le peut'''
+        index = self._cell(coord)
+        if index is None:
+            return 'The position ({}) is outside of the board'.format(coord)
+        if occupied >> index & 1:
+            return 'The position ({}) is not free'.format(coord)
+        if SUPPORTS[index] & ~occupied:
+            return 'The position ({}) is not stable'.format(coord)
+        return None
+
+    def _checkmove(self, move, player):
+        '''Retourne (code, None) si le coup move (dictionnaire du protocole) est
+        valide pour player, (None, raison du refus) sinon. Ne modifie pas l'état
+        et ne lève jamais d'exception, même si move est mal formé'''
+        if not isinstance(move, dict) or move.get('move') not in ('place', 'move'):
+            return None, 'Invalid Move:\n{}'.format(move)
+        if player != self._turn:
+            return None, 'It is not the turn of player {}'.format(player)
+        mine = self._board[player]
+        occupied = self._board[0] | self._board[1]
+        to = self._cell(move.get('to'))
+        if move['move'] == 'place':
+            if self._reserve[player] < 1:
+                return None, 'no more sphere'
+            code = 0
+        else:
+            # Une bille libre du joueur, qui monte d'étage
+            source = self._cell(move.get('from'))
+            if source is not None and to is not None and LAYER[to] <= LAYER[source]:
+                return None, 'you can only move to upper layer'
+            error = self._takeerror(move.get('from'), player, mine, occupied)
+            if error is not None:
+                return None, error
+            code = MOVE | source << 1
+            mine &= ~(1 << source)
+            occupied &= ~(1 << source)
+        # La bille déplacée ne peut pas soutenir sa nouvelle place : celle-ci n'est alors pas stable
+        error = self._puterror(move.get('to'), occupied)
+        if error is not None:
+            return None, error
+        code |= to << 6
+        mine |= 1 << to
+        occupied |= 1 << to
+        if 'remove' in move:
+            removes = move['remove']
+            for square in CELLSQUARES[to]:
+                if mine & square == square:
+                    break
+            else:
+                return None, 'You cannot remove spheres'
+            if not isinstance(removes, (list, tuple)):
+                return None, 'Invalid Move:\n{}'.format(move)
+            if len(removes) > 2:
+                return None, 'Can\'t remove more than 2 spheres'
+            # Les billes sont retirées l'une après l'autre
+            for i, coord in enumerate(removes):
+                error = self._takeerror(coord, player, mine, occupied)
+                if error is not None:
+                    return None, error
+                index = self._cell(coord)
+                mine &= ~(1 << index)
+                occupied &= ~(1 << index)
+                code |= index << 13 + 5 * i
+            code |= len(removes) << 11
+        return code, None
+
+    def islegal(self, move, player):
+        '''Regarde si update accepte le coup move pour player (c'est à son tour)'''
+        return self._checkmove(move, player)[0] is not None
 
     # update the state with the move
     # raise game.InvalidMoveException
     def update(self, move, player):
-        state = self._state['visible']
-        if move['move'] == 'place':
-            if state['reserve'][player] < 1:
-                raise game.InvalidMoveException('no more sphere')
-            self.set(move['to'], player)
-            state['reserve'][player] -= 1
-        elif move['move'] == 'move':
-            if move['to'][0] <= move['from'][0]:
-                raise game.InvalidMoveException('you can only move to upper layer')
-            sphere = self.remove(move['from'], player)
-            try:
-                self.set(move['to'], player)
-            except game.InvalidMoveException as e:
-                self.set(move['from'], player)
-                raise e
+        code, error = self._checkmove(move, player)
+        if code is None:
+            # Le coup refusé n'a pas touché à l'état
+            raise game.InvalidMoveException(error)
+        self.apply(code)
+
+    def apply(self, move):
+        '''Joue un coup (supposé valide) pour le joueur dont c'est le tour, sans
+        aucune vérification, et retourne l'enregistrement à donner à undo.
+        Le coup est un dictionnaire du protocole ou un entier (voir encodemove).'''
+        if not isinstance(move, int):
+            move = encodemove(move)
+        board = self._board
+        reserve = self._reserve
+        player = self._turn
+        keys = ZOBRIST[player]
+        record = (board[0], board[1], reserve[0], reserve[1], player, self._hash)
+        count = reserve[player]
+        value = self._hash ^ ZOBRISTTURN ^ ZOBRISTRESERVE[player][count]
+        mine = board[player]
+        if move & MOVE:
+            index = move >> 1 & 31
+            mine &= ~(1 << index)
+            value ^= keys[index]
         else:
-            raise game.InvalidMoveException('Invalid Move:\n{}'.format(move))
-
-        if 'remove' in move:
-            if not self.createSquare(move['to']):
-                raise game.InvalidMoveException('You cannot remove spheres')
-            if len(move['remove']) > 2:
-                raise game.InvalidMoveException('Can\'t remove more than 2 spheres')
-            for coord in move['remove']:
-                sphere = self.remove(coord, player)
-                state['reserve'][player] += 1
-
-        state['turn'] = (state['turn'] + 1) % 2
+            count -= 1
+        index = move >> 6 & 31
+        mine |= 1 << index
+        value ^= keys[index]
+        for i in range(move >> 11 & 3):
+            index = move >> 13 + 5 * i & 31
+            mine &= ~(1 << index)
+            value ^= keys[index]
+            count += 1
+        board[player] = mine
+        reserve[player] = count
+        self._hash = value ^ ZOBRISTRESERVE[player][count]
+        self._turn = 1 - player
+        return record
+
+    def undo(self, record):
+        '''Remet l'état exactement comme avant le apply qui a retourné record'''
+        self._board[0], self._board[1], self._reserve[0], self._reserve[1], self._turn, self._hash = record
 
     # return 0 or 1 if a winner, return None if draw, return -1 if game continue
     def winner(self):
-        state = self._state['visible']
-        if state['reserve'][0] < 1:
+        if self._reserve[0] < 1:
             return 1
-        elif state['reserve'][1] < 1:
+        elif self._reserve[1] < 1:
             return 0
         return -1
 
@@ -172,7 +664,7 @@ class PylosState(game.GameState):
 
     # print the state
     def prettyprint(self):
-        state = self._state['visible']
+        state = self.visible
         for layer in range(4):
             self.printSquare(state['board'][layer])
             print()
@@ -186,17 +678,54 @@ class PylosState(game.GameState):
         # print(json.dumps(self._state['visible'], indent=4))
 
 
+class PylosSnapshot(PylosState):
+    '''Instantané immuable d'un PylosState.
+
+    Il ne garde que la forme empaquetée (en tuples) et met en cache ses
+    sérialisations. Toute modification lève TypeError ; une copie (deepcopy)
+    redonne un PylosState modifiable.
+    '''
+
+    @classmethod
+    def _freeze(cls, state):
+        snapshot = cls.__new__(cls)
+        setattr = object.__setattr__
+        setattr(snapshot, '_board', tuple(state._board))
+        setattr(snapshot, '_reserve', tuple(state._reserve))
+        setattr(snapshot, '_turn', state._turn)
+        setattr(snapshot, '_hash', state._hash)
+        setattr(snapshot, '_serialized', {})
+        return snapshot
+
+    def __setattr__(self, name, value):
+        raise TypeError('a PylosSnapshot cannot be modified')
+
+    def __deepcopy__(self, memo):
+        state = PylosState.__new__(PylosState)
+        state._board = list(self._board)
+        state._reserve = list(self._reserve)
+        state._turn = self._turn
+        state._hash = self._hash
+        return state
+
+    def snapshot(self):
+        return self
+
+    def serialize(self, binary=False):
+        serialized = self._serialized.get(binary)
+        if serialized is None:
+            serialized = self._serialized[binary] = super().serialize(binary)
+        return serialized
+
+
 class PylosServer(game.GameServer):
     '''Class representing a server for the Pylos game.'''
 
-    def __init__(self, verbose=False):
-        super().__init__('Pylos', 2, PylosState(), verbose=verbose)
+    def __init__(self, verbose=False, series=1, log=None, stats=None):
+        super().__init__('Pylos', 2, PylosState(), verbose=verbose, series=series, log=log, stats=stats)
 
     def applymove(self, move):
-        try:
-            self._state.update(json.loads(move), self.currentplayer)
-        except json.JSONDecodeError:
-            raise game.InvalidMoveException('move must be valid JSON string: {}'.format(move))
+        self._state.applymove(move, self.currentplayer)
 
 
 class PylosClient(game.GameClient):
@@ -204,9 +733,16 @@ class PylosClient(game.GameClient):
 
     def __init__(self, name, server, verbose=False):
         self.__dontmove = []
-        super().__init__(server, PylosState, verbose=verbose)
+        # Sous-arbre du coup joué au tour précédent, réutilisé au tour suivant
+        self.__tree = None
+        super().__init__(server, PylosState, verbose=verbose, name=name)
         self.__name = name
 
+    def _newgame(self):
+        # Les billes à ne pas bouger ne valent que pour la partie en cours
+        self.__dontmove = []
+        self.__tree = None
+
     def _handle(self, message):
         pass
 
@@ -237,9 +773,15 @@ class PylosClient(game.GameClient):
         '''
 
         iterration = 3
-        t = Tree(state, 0, iterration)
+        # On repart du noeud de l'arbre précédent qui correspond au coup de l'adversaire
+        t = self.__tree.find(state.key, 1) if self.__tree is not None else None
+        self.__tree = None
+        if t is None:
+            t = Tree(state, 0, iterration, lazy=True)
+        else:
+            t.deepen(iterration - t.iterration)
 
-        if state._state['visible']['turn'] == 0:
+        if state.turn == 0:
             player = 0
             notplayer = 1
 
@@ -250,21 +792,23 @@ class PylosClient(game.GameClient):
         save_reserve = -2
         children = 0
         bestmove = {}
+        bestnode = None
         coup = {}
 
         for gen1 in t:
             children += 1
-            etat1 = gen1.state._state['visible']
+            previous = bestnode
+            etat1 = gen1.reserve
 
             # Verifie que si c'est le dernier tour on place juste la bille au seul endroit libre
             if gen1.coup['move'] == 'place':
-                if etat1['reserve'][notplayer] == 1 or etat1['reserve'][player] == 1:
+                if etat1[notplayer] == 1 or etat1[player] == 1:
                     coup['move'] = gen1.coup['move']
                     coup['to'] = list(gen1.coup['to'])
 
                     return json.dumps(coup)
             else:
-                if etat1['reserve'][notplayer] == 1 or etat1['reserve'][player] == 1:
+                if etat1[notplayer] == 1 or etat1[player] == 1:
                     coup['move'] = gen1.coup['move']
                     coup['from'] = list(gen1.coup['from'])
                     coup['to'] = list(gen1.coup['to'])
@@ -272,7 +816,7 @@ class PylosClient(game.GameClient):
                     return json.dumps(coup)
 
             for gen2 in gen1:
-                etat2 = gen2.state._state['visible']
+                etat2 = gen2.reserve
 
                 # Fait en sorte de bloquer un carré
                 coup_2 = gen2.coup['to']
@@ -280,25 +824,20 @@ class PylosClient(game.GameClient):
                 row = coup_2[1]
                 collumn = coup_2[2]
 
-                try:
-                    if state._state['visible']['board'][coup_2[0]][coup_2[1]][coup_2[2]] is None:
-                        if gen2.state.createSquare(coup_2):
-                            state.validPosition(layer, row, collumn)
-                            print("Je bloque le carré")
-                            self.__dontmove.append(coup_2)
-                            return json.dumps({'move': 'place',
-                                               'to': list(coup_2)})
-                except:
-                    pass
+                if state.isplaceable(layer, row, collumn) and state.completessquare(coup_2, notplayer):
+                    print("Je bloque le carré")
+                    self.__dontmove.append(coup_2)
+                    return json.dumps({'move': 'place',
+                                       'to': list(coup_2)})
 
                 for gen3 in gen2:
-                    etat3 = gen3.state._state['visible']
+                    etat3 = gen3.reserve
 
                     # Creation du delta des reserves pour qu'il soit toujour positif en fonction du joueur
                     deltareserve = 0
-                    deltareserve += etat1['reserve'][player] - etat1['reserve'][notplayer]
-                    deltareserve += etat2['reserve'][player] - etat2['reserve'][notplayer]
-                    deltareserve += etat3['reserve'][player] - etat3['reserve'][notplayer]
+                    deltareserve += etat1[player] - etat1[notplayer]
+                    deltareserve += etat2[player] - etat2[notplayer]
+                    deltareserve += etat3[player] - etat3[notplayer]
 
                     # Permet de savoir si le mouvement qu'on va faire ne vas pas librer un carré possible
                     if gen1.coup['move'] == 'move':
@@ -308,13 +847,24 @@ class PylosClient(game.GameClient):
                             if deltareserve >= save_reserve:
                                 save_reserve = deltareserve
                                 bestmove = gen1.coup
+                                bestnode = gen1
 
                     if deltareserve >= save_reserve:
                         save_reserve = deltareserve
                         bestmove = gen1.coup
+                        bestnode = gen1
+
+            # Le sous-arbre de gen1 a été entièrement évalué : on ne garde que
+            # celui du meilleur coup, pour le tour suivant
+            if bestnode is not gen1:
+                gen1.prune()
+            elif previous is not None:
+                previous.prune()
 
         if len(bestmove) == 0:
             bestmove = t[random.randint(0, children-1)].coup
+        else:
+            self.__tree = bestnode
 
         if bestmove['move'] == 'place':
             coup['move'] = bestmove['move']
@@ -340,16 +890,39 @@ class PylosClient(game.GameClient):
 #                        })
 
 class Tree:
-    def __init__(self, state, tour, iterration, coup={}, children=[]):
-        self.__state = copy.deepcopy(state)
-        self.__player = self.__state._state['visible']['turn']
-        self.__iterration = iterration
-        self.__coup = coup  # Permet de savoir si on place ou si on bouge et où
+    '''Arbre des coups à partir d'un état.
 
-        self.__children = copy.deepcopy(children)
-        self.__tour = tour
+    Chaque noeud ne garde que la clé empaquetée de son état (PylosState.key) et
+    le code de son coup (encodemove). L'état et le coup au format du protocole
+    sont recréés quand on les demande.
 
-        self._coupvalide(self.__state)
+    Par défaut tout l'arbre est construit dès la création. Avec lazy=True, les
+    enfants ne sont créés qu'au moment où on les parcourt ou on y accède par
+    index, et les branches jamais visitées ne sont jamais construites.
+    '''
+
+    __slots__ = ('__key', '__code', '__iterration', '__tour', '__lazy', '__children', '__pending')
+
+    # Coup de la racine, qui n'en a pas
+    NOCOUP = {'move': '', 'to': '', 'from': ''}
+
+    def __init__(self, state, tour, iterration, coup={}, children=[], lazy=False):
+        self._setup(state.key, encodemove(coup) if len(coup) > 0 else None, tour, iterration, lazy)
+        if len(children) > 0:
+            self.__children = list(children)
+        if not lazy:
+            self._expand()
+
+    def _setup(self, key, code, tour, iterration, lazy):
+        self.__key = key
+        self.__code = code  # Permet de savoir si on place ou si on bouge et où
+        self.__iterration = iterration
+        self.__tour = tour
+        self.__lazy = lazy
+        # Liste des enfants créés, None tant qu'il n'y en a aucun
+        self.__children = None
+        # Générateur des enfants pas encore créés (aucun pour les feuilles)
+        self.__pending = self._coupvalide() if iterration > 0 else None
 
     def __str__(self):
         '''Affiche l'arbre et ses enfants'''
@@ -367,174 +940,130 @@ class Tree:
         return _str(self, 0)
 
     def __getitem__(self, item):
+        '''Permet d'accéder aux enfants par index'''
+        if isinstance(item, int) and item >= 0:
+            self._expand(item + 1)
+        else:
+            self._expand()
+        return self.children[item]
+
+    def __iter__(self):
         '''Permet de faire des boucle for dans l'arbre'''
-        return self.__children[item]
+        index = 0
+        while True:
+            self._expand(index + 1)
+            if self.__children is None or index >= len(self.__children):
+                return
+            yield self.__children[index]
+            index += 1
+
+    def _expand(self, count=None):
+        '''Crée les enfants jusqu'à en avoir count (tous si count vaut None)'''
+        while self.__pending is not None and (count is None or self.__children is None or
+                                              len(self.__children) < count):
+            if next(self.__pending, None) is None:
+                self.__pending = None
+
+    def prune(self):
+        '''Oublie les enfants déjà créés, ils seront recréés si on les reparcourt'''
+        self.__children = None
+        self.__pending = self._coupvalide() if self.__iterration > 0 else None
+
+    @property
+    def key(self):
+        return self.__key
+
+    @property
+    def iterration(self):
+        return self.__iterration
+
+    def find(self, key, depth):
+        '''Cherche parmi les descendants déjà créés, jusqu'à depth niveaux plus
+        bas, le noeud de l'état dont la clé est key (None s'il n'y en a pas)'''
+        if self.__key == key:
+            return self
+        if depth > 0:
+            for child in self.__children or ():
+                node = child.find(key, depth - 1)
+                if node is not None:
+                    return node
+        return None
+
+    def deepen(self, extra):
+        '''Ajoute extra niveaux à l'arbre en gardant les enfants déjà créés'''
+        self.__iterration += extra
+        # Une ancienne feuille peut maintenant avoir des enfants
+        if self.__children is None and self.__pending is None and self.__iterration > 0:
+            self.__pending = self._coupvalide()
+        for child in self.__children or ():
+            child.deepen(extra)
+        if not self.__lazy:
+            self._expand()
 
     @property
     def state(self):
-        return self.__state
+        return PylosState.fromkey(self.__key)
+
+    @property
+    def reserve(self):
+        return self.__key >> 60 & 15, self.__key >> 64 & 15
 
     @property
     def children(self):
-        return self.__children
+        self._expand()
+        return self.__children if self.__children is not None else []
+
+    @property
+    def code(self):
+        return self.__code
 
     @property
     def coup(self):
-        coup = {}
-        if len(self.__coup) == 0:
-            coup['move'] = ''
-            coup['to'] = ''
-            coup['from'] = ''
-            return coup
-        else:
-            return self.__coup
+        if self.__code is None:
+            return Tree.NOCOUP
+        coup = decodemove(self.__code)
+        coup['to'] = tuple(coup['to'])
+        coup['from'] = tuple(coup['from']) if 'from' in coup else ''
+        return coup
 
     def _possibleplacement(self, state):
         '''Enregistre toute les places où on peut faire un placement'''
-        possibleplacement = []
-        for move in self._getplace(state):
-            try:
-                state.validPosition(move[0], move[1], move[2])
-                possibleplacement.append(move)
-            except:
-                pass
-
-        return possibleplacement
-
-    def _getplace(self, state):
-        '''Cherche toute les places vide sur le plateau'''
-        statue = state._state['visible']['board']
-        move = []
-        layer = 0
-
-        while layer <= 3:
-            number_line = 0
-            indice = 0
-            long_layer = len(statue[layer])
-
-            while number_line < long_layer:
-                lines = statue[layer][number_line]
-
-                for place in lines:
-                    if place is None:
-                        move.append((layer, indice // long_layer, indice % long_layer))
-                    indice += 1
-
-                number_line += 1
-            layer += 1
-        return move
+        return state.placements()
 
     def _possiblemove(self, state):
         '''Enregistre toute les places des billes qu'on peut déplacer'''
-        possiblemove = []
-        for move in self._getmove(state):
-            try:
-                state.canMove(move[0], move[1], move[2])
-                possiblemove.append(move)
-            except:
-                pass
-
-        return possiblemove
-
-    def _getmove(self, state):
-        '''Cherche toute les places des billes qui sont à nous'''
-        move = []
-        statue = state._state['visible']['board']
-        player = state._state['visible']['turn']
-        layer = 0
-
-        while layer < 3:
-            long_layer = len(statue[layer])
-            indice = 0
-            number_line = 0
-
-            while number_line < long_layer:
-                lines = statue[layer][number_line]
-
-                for place in lines:
-                    if place is not None and place == player:
-                        move.append((layer, indice // long_layer, indice % long_layer))
-                    indice += 1
-
-                number_line += 1
-            layer += 1
-
-        return move
-
-    def _coupvalide(self, state):
+        return [move for move in state.movables(state.turn) if move[0] < 3]
+
+    def _coupvalide(self):
+        '''Générateur qui crée les enfants un par un'''
+        state = PylosState.fromkey(self.__key)
         possibleplacement = self._possibleplacement(state)
         possiblemove = self._possiblemove(state)
 
         # Pour chaque PLACEMENT possible on créé des enfants
-        for move in possibleplacement:
-            new_state = copy.deepcopy(state)
-            new_state._state['visible']['board'][move[0]][move[1]][move[2]] = self.__player
-            new_state._state['visible']['reserve'][self.__player] -= 1
-
-            # limitation des ittérations
-            if self.__iterration > 0:
-                if self.__player == 0:
-                    # Permetra de savoir le mouvement et la coord
-                    movement = {}
-                    movement['move'] = 'place'
-                    movement['to'] = move
-                    movement['from'] = ''
-
-                    iterration = self.__iterration - 1
-                    new_state._state['visible']['turn'] = 1
-                    tour = self.__tour + 1
-                    self.__children.append(Tree(new_state, tour, iterration, movement))
-                else:
-                    # Permetra de savoir le mouvement et la coord
-                    movement = {}
-                    movement['move'] = 'place'
-                    movement['to'] = move
-                    movement['from'] = ''
-
-                    iterration = self.__iterration - 1
-                    new_state._state['visible']['turn'] = 0
-                    tour = self.__tour + 1
-                    self.__children.append(Tree(new_state, tour, iterration, movement))
+        for place in possibleplacement:
+            yield self._addchild(state, encodemove({'move': 'place', 'to': place}))
 
         # Pour chaque MOUVEMENT possible on crée des enfants
         # (prendre une boulle du plateau et la poser au layer suivant)
         for move in possiblemove:  # Prend chaque boulle qu'on peut bouger
             for place in possibleplacement:  # Prend chaque postion libre
-                new_state = copy.deepcopy(state)
-
-                if place[0] > move[0]:
-                    try:
-                        # Enleve la boulle, verifie la position final et place la boule
-                        new_state._state['visible']['board'][move[0]][move[1]][move[2]] = None
-                        new_state.validPosition(place[0], place[1], place[2])
-                        new_state._state['visible']['board'][place[0]][place[1]][place[2]] = self.__player
-
-                        # limitation des ittérations
-                        if self.__iterration > 0:
-                            if self.__player == 0:
-                                # Permetra de savoir le mouvement et les coords
-                                mouvement = {}
-                                movement['move'] = 'move'
-                                movement['to'] = place
-                                movement['from'] = move
-
-                                iterration = self.__iterration - 1
-                                new_state._state['visible']['turn'] = 1
-                                tour = self.__tour + 1
-                                self.__children.append(Tree(new_state, tour, iterration, movement))
-                            else:
-                                # Permetra de savoir le mouvement et les coords
-                                movement = {}
-                                movement['move'] = 'move'
-                                movement['to'] = place
-                                movement['from'] = move
-
-                                iterration = self.__iterration - 1
-                                new_state._state['visible']['turn'] = 0
-                                tour = self.__tour + 1
-                                self.__children.append(Tree(new_state, tour, iterration, movement))
-                    except:
-                        pass
+                # La boulle déplacée ne peut pas être un support de sa nouvelle place
+                if place[0] > move[0] and not SUPPORTS[cellindex(*place)] >> cellindex(*move) & 1:
+                    yield self._addchild(state, encodemove({'move': 'move', 'from': move, 'to': place}))
+
+    def _addchild(self, state, code):
+        '''Joue le coup sur l'état, crée l'enfant à partir de là puis annule le coup'''
+        record = state.apply(code)
+        child = Tree.__new__(Tree)
+        child._setup(state.key, code, self.__tour + 1, self.__iterration - 1, self.__lazy)
+        state.undo(record)
+        if not self.__lazy:
+            child._expand()
+        if self.__children is None:
+            self.__children = []
+        self.__children.append(child)
+        return child
 
 
 if __name__ == '__main__':
@@ -545,6 +1074,14 @@ if __name__ == '__main__':
     server_parser = subparsers.add_parser('server', help='launch a server')
     server_parser.add_argument('--host', help='hostname (default: localhost)', default='localhost')
     server_parser.add_argument('--port', help='port to listen on (default: 5000)', default=5000)
+    server_parser.add_argument('--lobby', action='store_true',
+                               help='keep accepting clients and run many games at once')
+    server_parser.add_argument('--series', type=int, default=1,
+                               help='games played by the same players, swapping colours (default: 1)')
+    server_parser.add_argument('--log', help='append every finished game to this binary game log')
+    server_parser.add_argument('--stats', nargs='?', const='-', metavar='FILE',
+                               help='time the phases of every turn and write a JSON summary per game '
+                                    'to FILE (default: standard output)')
     server_parser.add_argument('--verbose', action='store_true')
     # Create the parser for the 'client' subcommand
     client_parser = subparsers.add_parser('client', help='launch a client')
@@ -555,6 +1092,16 @@ if __name__ == '__main__':
     # Parse the arguments of sys.args
     args = parser.parse_args()
     if args.component == 'server':
-        PylosServer(verbose=args.verbose).run()
+        log = gamelog.GameLog(args.log) if args.log else None
+        stats = None if args.stats is None else sys.stdout if args.stats == '-' else open(args.stats, 'a')
+        if args.lobby:
+            game.GameLobby(lambda: PylosServer(series=args.series, log=log, stats=stats), port=int(args.port),
+                           verbose=args.verbose).run()
+        else:
+            PylosServer(verbose=args.verbose, series=args.series, log=log, stats=stats).run()
+        if log is not None:
+            log.close()
+        if stats not in (None, sys.stdout):
+            stats.close()
     else:
         PylosClient(args.name, (args.host, args.port), verbose=args.verbose)
\ No newline at end of file
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# replay.py
+# Replays the Pylos games of binary game logs (see lib/gamelog.py) to check
+# them and compute statistics. Each log file is a shard handled by one of a
+# pool of worker processes.
+#
+# Usage: python replay.py games-*.log --processes 8 --openings 4
+#        python replay.py games.log --position 1234 20
+
+import argparse
+import collections
+import multiprocessing
+import time
+
+import pylos
+from lib import game
+from lib import gamelog
+
+
+def replay(loggedgame, plies=None):
+    '''Replay the first 'plies' moves (all by default) of a logged game with
+    PylosState.update and return the state reached.
+
+    Raises InvalidMoveException: If a move of the game is not valid.
+    '''
+    state = pylos.PylosState()
+    for ply, (move, player) in enumerate(loggedgame.moves(pylos.PylosState)):
+        if ply == plies:
+            break
+        state.update(move.todict(), player)
+    return state
+
+
+def replayshard(task):
+    '''Replay every game of one log and return its statistics.
+
+    'task' is (path, openings): the openings counted are the sequences of the
+    first 'openings' moves.
+    '''
+    path, openings = task
+    stats = {
+        'games': 0,
+        'plies': 0,
+        'wins': [0, 0],
+        'draws': 0,
+        # Game ids of the games with an invalid move or a wrong recorded result
+        'invalid': [],
+        # First move: [games, games won by the first player]
+        'firstmoves': collections.defaultdict(lambda: [0, 0]),
+        'openings': collections.Counter(),
+    }
+    with gamelog.GameLogReader(path) as log:
+        for loggedgame in log:
+            stats['games'] += 1
+            stats['plies'] += len(loggedgame)
+            try:
+                state = replay(loggedgame)
+            except game.InvalidMoveException:
+                stats['invalid'].append(loggedgame.gameid)
+                continue
+            winner = loggedgame.winner
+            if state.winner() != winner:
+                stats['invalid'].append(loggedgame.gameid)
+                continue
+            if winner is None:
+                stats['draws'] += 1
+            else:
+                stats['wins'][winner] += 1
+            moves = [move for move, player in loggedgame.moves(pylos.PylosState)]
+            if moves:
+                first = stats['firstmoves'][moves[0]]
+                first[0] += 1
+                first[1] += winner == 0
+            if len(moves) >= openings:
+                stats['openings'][tuple(moves[:openings])] += 1
+    stats['firstmoves'] = dict(stats['firstmoves'])
+    return stats
+
+
+def merge(total, stats):
+    '''Add the statistics of a shard to 'total'.'''
+    for key in ('games', 'plies', 'draws'):
+        total[key] += stats[key]
+    for player in range(2):
+        total['wins'][player] += stats['wins'][player]
+    total['invalid'].extend(stats['invalid'])
+    for move, (games, won) in stats['firstmoves'].items():
+        total['firstmoves'][move][0] += games
+        total['firstmoves'][move][1] += won
+    total['openings'].update(stats['openings'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay and analyse Pylos game logs')
+    parser.add_argument('logs', nargs='+', help='game log files (one shard each)')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--openings', type=int, default=3, help='length of the counted openings (default: 3)')
+    parser.add_argument('--top', type=int, default=10, help='number of openings and first moves shown (default: 10)')
+    parser.add_argument('--position', type=int, nargs=2, metavar=('GAME', 'PLY'),
+                        help='only print the position of a game of the first log after PLY moves')
+    args = parser.parse_args()
+
+    if args.position is not None:
+        gameid, plies = args.position
+        with gamelog.GameLogReader(args.logs[0]) as log:
+            loggedgame = log.game(gameid)
+            print('Game {} ({} vs {}), {} moves, position after {}:'.format(
+                gameid, loggedgame.names[0] or 'Anonymous', loggedgame.names[1] or 'Anonymous', len(loggedgame),
+                min(plies, len(loggedgame))
+            ))
+            replay(loggedgame, plies).prettyprint()
+        return
+
+    total = {
+        'games': 0, 'plies': 0, 'wins': [0, 0], 'draws': 0, 'invalid': [],
+        'firstmoves': collections.defaultdict(lambda: [0, 0]), 'openings': collections.Counter(),
+    }
+    start = time.perf_counter()
+    with multiprocessing.Pool(min(args.processes, len(args.logs))) as pool:
+        for stats in pool.imap_unordered(replayshard, [(path, args.openings) for path in args.logs]):
+            merge(total, stats)
+    elapsed = time.perf_counter() - start
+
+    games = total['games']
+    print('{} games ({} plies) replayed from {} logs in {:.1f} s ({:.0f} plies/s)'.format(
+        games, total['plies'], len(args.logs), elapsed, total['plies'] / elapsed if elapsed else 0
+    ))
+    if games == 0:
+        return
+    print('  invalid games  {}{}'.format(len(total['invalid']), ' (ids {})'.format(total['invalid'][:10])
+                                         if total['invalid'] else ''))
+    print('  average length {:.1f} plies'.format(total['plies'] / games))
+    print('  first player wins {:.1%}, second player wins {:.1%}, draws {}'.format(
+        total['wins'][0] / games, total['wins'][1] / games, total['draws']
+    ))
+    print('  win rate of the first player by first move:')
+    firstmoves = sorted(total['firstmoves'].items(), key=lambda item: -item[1][0])
+    for move, (played, won) in firstmoves[:args.top]:
+        print('    {:>7} games  {:>6.1%}  {}'.format(played, won / played, move))
+    print('  most frequent openings ({} moves):'.format(args.openings))
+    for opening, count in total['openings'].most_common(args.top):
+        print('    {:>7} games  {}'.format(count, '  '.join(map(str, opening))))
+
+
+if __name__ == '__main__':
+    main()
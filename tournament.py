@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# tournament.py
+# Headless self-play between the Pylos clients, without game server nor sockets.
+# Games are played in-process, spread over a pool of worker processes.
+#
+# Usage: python tournament.py tree minimax --games 1000 --processes 8
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import multiprocessing
+import random
+import time
+
+import pylos
+import pylos_non_mod
+import pylosfinale
+from lib import game
+
+ENGINES = ('tree', 'minimax', 'first')
+
+
+def _client(engine, options):
+    '''Create an in-process client (no server) for the given engine.'''
+    if engine == 'tree':
+        return pylos.PylosClient(engine, None)
+    if engine == 'minimax':
+        return pylosfinale.PylosClient(engine, None, depth=options['depth'], thinktime=options['thinktime'],
+                                       ttsize=options['ttsize'])
+    return pylos_non_mod.PylosClient(engine, None)
+
+
+def playgame(task):
+    '''Play one game and return (winner, plies, think time, forfeit).
+
+    'task' is (engines, seed, options) where engines[i] plays as player i.
+    winner is the index of the winning player or None if the game was stopped
+    after options['maxplies'] plies. An invalid move loses the game (forfeit).
+    '''
+    engines, seed, options = task
+    random.seed(seed)
+    clients = [_client(engine, options) for engine in engines]
+    state = pylos.PylosState()
+    plies = 0
+    thinking = 0.0
+    output = io.StringIO()
+    while state.winner() == -1 and plies < options['maxplies']:
+        player = state.turn
+        start = time.perf_counter()
+        # The clients print their own traces on stdout
+        with contextlib.redirect_stdout(output):
+            move = clients[player]._nextmove(copy.deepcopy(state))
+        thinking += time.perf_counter() - start
+        try:
+            state.update(json.loads(move), player)
+        except (game.InvalidMoveException, ValueError, KeyError):
+            return 1 - player, plies, thinking, True
+        plies += 1
+        output.seek(0)
+        output.truncate()
+    winner = state.winner()
+    return (None if winner == -1 else winner), plies, thinking, False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pylos self-play tournament')
+    parser.add_argument('engines', nargs=2, choices=ENGINES, help='the two engines to play against each other')
+    parser.add_argument('--games', type=int, default=100, help='number of games (default: 100)')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--depth', type=int, help='minimax search depth (default: 3)')
+    parser.add_argument('--think-time', type=float, dest='thinktime', help='minimax seconds per move')
+    parser.add_argument('--tt-size', type=int, dest='ttsize', default=1 << 16,
+                        help='minimax transposition table slots (default: 65536)')
+    parser.add_argument('--max-plies', type=int, dest='maxplies', default=200,
+                        help='stop a game after this many plies (default: 200)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game (default: 0)')
+    args = parser.parse_args()
+
+    options = {'depth': args.depth, 'thinktime': args.thinktime, 'ttsize': args.ttsize, 'maxplies': args.maxplies}
+    names = args.engines
+    # Colours alternate: engine 0 plays first in even games
+    tasks = [((names[i % 2], names[1 - i % 2]), args.seed + i, options) for i in range(args.games)]
+
+    wins = [0, 0]
+    forfeits = [0, 0]
+    unfinished = 0
+    plies = 0
+    thinking = 0.0
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.processes) as pool:
+        for i, (winner, length, elapsed, forfeit) in enumerate(pool.imap(playgame, tasks, chunksize=4)):
+            plies += length
+            thinking += elapsed
+            if winner is None:
+                unfinished += 1
+                continue
+            # Map the winning player back to the engine that played it
+            engine = winner if i % 2 == 0 else 1 - winner
+            wins[engine] += 1
+            if forfeit:
+                forfeits[1 - engine] += 1
+    elapsed = time.perf_counter() - start
+
+    games = args.games
+    label = '{} vs {}'.format(*names) if names[0] != names[1] else '{0} (A) vs {0} (B)'.format(names[0])
+    print('{}: {} games in {:.1f} s ({} processes)'.format(label, games, elapsed, args.processes))
+    for i, name in enumerate(names if names[0] != names[1] else (names[0] + ' (A)', names[1] + ' (B)')):
+        print('  {:<14} wins {:>6} ({:.1%}), forfeits {}'.format(name, wins[i], wins[i] / games, forfeits[i]))
+    if unfinished:
+        print('  {:<14} {:>6}'.format('unfinished', unfinished))
+    print('  average length {:.1f} plies, {:.0f} moves/s of think time, {:.0f} moves/s overall'.format(
+        plies / games, plies / thinking if thinking else 0, plies / elapsed
+    ))
+
+
+if __name__ == '__main__':
+    main()